@@ -0,0 +1,119 @@
+import asyncio
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from sqlalchemy import update, bindparam, select
+
+from api.config import config
+from api.database import get_async_session_context
+from api.models import User
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+
+class ActiveUserWindow:
+    """
+    最近 window 内活跃的用户；按最后活跃时间排序，统计时从头部淘汰过期的用户，均摊 O(1)
+    """
+
+    def __init__(self, window: timedelta):
+        self.window = window
+        # user_id -> 最后活跃时间，越早活跃的越靠前
+        self.users: OrderedDict[int, datetime] = OrderedDict()
+
+    def touch(self, user_id: int, active_time: datetime):
+        self.users[user_id] = active_time
+        self.users.move_to_end(user_id)
+
+    def count(self, now: datetime = None) -> int:
+        expire_time = (now or datetime.utcnow()) - self.window
+        while self.users:
+            user_id, active_time = next(iter(self.users.items()))
+            if active_time > expire_time:
+                break
+            self.users.popitem(last=False)
+        return len(self.users)
+
+
+class ActivityTracker:
+    """
+    用户最后活跃时间先记录在内存中，每隔 activity_flush_interval 秒以一条批量 UPDATE 写入数据库，关闭时写完剩余的记录
+    同时在内存中维护 5m/1h/1d 内活跃的普通用户，统计在线人数时无需查询数据库
+    """
+
+    def __init__(self):
+        self.flush_interval = config.get("activity_flush_interval", 30)
+        # user_id -> 尚未写入数据库的最后活跃时间
+        self.pending: dict[int, datetime] = {}
+        self.windows = {
+            "5m": ActiveUserWindow(timedelta(minutes=5)),
+            "1h": ActiveUserWindow(timedelta(hours=1)),
+            "1d": ActiveUserWindow(timedelta(days=1)),
+        }
+        self.worker: asyncio.Task | None = None
+
+    async def load(self):
+        """启动时从数据库载入最近一天内活跃的普通用户（使用 active_time 索引）"""
+        async with get_async_session_context() as session:
+            r = await session.execute(
+                select(User.id, User.active_time)
+                .where(User.active_time > datetime.utcnow() - timedelta(days=1), User.is_superuser.is_(False))
+                .order_by(User.active_time))
+            for user_id, active_time in r:
+                for window in self.windows.values():
+                    window.touch(user_id, active_time)
+
+    def start(self):
+        self.worker = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.worker is None:
+            return
+        self.worker.cancel()
+        try:
+            await self.worker
+        except asyncio.CancelledError:
+            pass
+        self.worker = None
+        await self.flush()
+
+    def touch(self, user_id: int, active_time: datetime = None, is_superuser: bool = False):
+        active_time = active_time or datetime.utcnow()
+        self.pending[user_id] = active_time
+        # 在线人数不统计管理员
+        if not is_superuser:
+            for window in self.windows.values():
+                window.touch(user_id, active_time)
+
+    def count_active_users(self) -> dict[str, int]:
+        """5m/1h/1d 内活跃的普通用户数"""
+        now = datetime.utcnow()
+        return {key: window.count(now) for key, window in self.windows.items()}
+
+    def get_active_time(self, user_id: int, default: datetime | None = None) -> datetime | None:
+        """未写入数据库时以内存中的为准"""
+        return self.pending.get(user_id, default)
+
+    async def flush(self):
+        if not self.pending:
+            return
+        pending, self.pending = self.pending, {}
+        try:
+            async with get_async_session_context() as session:
+                await session.execute(
+                    update(User.__table__).where(User.__table__.c.id == bindparam("b_user_id"))
+                    .values(active_time=bindparam("b_active_time")),
+                    [{"b_user_id": user_id, "b_active_time": active_time}
+                     for user_id, active_time in pending.items()])
+                await session.commit()
+        except Exception as e:
+            logger.warning(f"Save active time of {len(pending)} users failed: {e}")
+            # 放回队列，下次重试；期间更新的时间优先
+            for user_id, active_time in pending.items():
+                self.pending.setdefault(user_id, active_time)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
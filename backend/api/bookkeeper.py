@@ -0,0 +1,266 @@
+import asyncio
+from datetime import datetime
+
+from sqlalchemy import update, bindparam
+from sqlalchemy.exc import OperationalError
+
+from api.config import config
+from api.database import get_async_session_context
+from api.enums import ChatModels
+from api.mirror import append_ask_messages
+from api.models import Conversation
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+
+class AskRecord:
+    """
+    一次提问结束后需要记录的内容
+    """
+
+    def __init__(self, user_id: int, conversation_id: str, model_name: ChatModels, is_new_conv: bool,
+                 new_title: str = None, title_message_id: str = None, message: str = None, reply: dict = None,
+                 account_name: str = None):
+        self.user_id = user_id
+        self.conversation_id = conversation_id
+        self.model_name = model_name
+        # 提问所在的账号，新对话以此记录所属账号
+        self.account_name = account_name
+        self.is_new_conv = is_new_conv
+        self.new_title = new_title
+        self.finish_time = datetime.utcnow()
+        # 提问内容和最后一次回复，用于写入本地镜像
+        self.message = message
+        self.reply = reply
+        # 对话和镜像写入数据库后完成；写入失败时为异常
+        self.saved = asyncio.get_running_loop().create_future()
+        self.saved.add_done_callback(lambda f: f.cancelled() or f.exception())
+        # 不为空时，在对话写入数据库后以该消息自动生成标题，结果通过 title_future 返回
+        self.title_message_id = title_message_id
+        self.title_future: asyncio.Future | None = None
+        if title_message_id is not None:
+            self.title_future = asyncio.get_running_loop().create_future()
+            self.title_future.add_done_callback(lambda f: f.cancelled() or f.exception())
+
+    def fail(self, e: Exception):
+        for future in (self.saved, self.title_future):
+            if future is not None and not future.done():
+                future.set_exception(e)
+
+
+class AskBookkeeper:
+    """
+    提问结束后的记录工作（设置默认标题、写入/更新对话、写入消息镜像）在后台批量执行，
+    使账号在回复结束后立即释放：
+    - 队列有上限，队列满时提交者等待
+    - 积压的记录合并在一次事务中提交；失败时按退避间隔重试，仍失败则逐条提交，避免一条记录影响整批
+    - 关闭时写完队列中剩余的记录，关闭后提交的记录直接写入
+    """
+
+    def __init__(self, chatgpt_manager, title_generator):
+        self.chatgpt_manager = chatgpt_manager
+        self.title_generator = title_generator
+        self.max_queue_size = config.get("bookkeeping_queue_size", 1000)
+        self.batch_size = config.get("bookkeeping_batch_size", 100)
+        self.retry_times = config.get("bookkeeping_retry_times", 3)
+        self.retry_interval = config.get("bookkeeping_retry_interval", 1)
+        self.queue: asyncio.Queue[AskRecord | None] | None = None
+        self.worker: asyncio.Task | None = None
+        # conversation_id -> 该对话最后一条尚未写入的记录
+        self.pending: dict[str, AskRecord] = {}
+
+    def start(self):
+        self.queue = asyncio.Queue(self.max_queue_size)
+        self.worker = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.worker is None:
+            return
+        await self.queue.put(None)
+        await self.worker
+        self.worker = None
+        # worker 结束后才放入队列的记录（包括队列满时等待中的提交者）
+        while not self.queue.empty():
+            records = [record for record in self._drain() if record is not None]
+            if records:
+                await self._flush(records)
+        self.queue = None
+
+    def _drain(self) -> list[AskRecord | None]:
+        records = []
+        while not self.queue.empty():
+            records.append(self.queue.get_nowait())
+        return records
+
+    def _track(self, record: AskRecord):
+        conversation_id = record.conversation_id
+        if conversation_id is None:
+            return
+        self.pending[conversation_id] = record
+
+        def untrack(_):
+            if self.pending.get(conversation_id) is record:
+                del self.pending[conversation_id]
+
+        record.saved.add_done_callback(untrack)
+
+    async def wait_for_conversation(self, conversation_id: str) -> bool:
+        """
+        等待该对话尚未写入的记录，使镜像中的 current_node 是最新的
+        返回 False 表示记录写入失败，镜像可能落后，应以上游为准
+        """
+        record = self.pending.get(conversation_id)
+        if record is None:
+            return True
+        try:
+            await asyncio.shield(record.saved)
+        except Exception:
+            return False
+        return True
+
+    async def submit(self, record: AskRecord):
+        self._track(record)
+        if self.worker is None:
+            # 未启动或已关闭时直接写入
+            await self._flush([record])
+            return
+        await self.queue.put(record)
+
+    async def _run(self):
+        stopping = False
+        while not stopping:
+            records = []
+            record = await self.queue.get()
+            while True:
+                if record is None:
+                    stopping = True
+                else:
+                    records.append(record)
+                if stopping or len(records) >= self.batch_size or self.queue.empty():
+                    break
+                record = self.queue.get_nowait()
+            if stopping:
+                records.extend(record for record in self._drain() if record is not None)
+            if records:
+                try:
+                    await self._flush(records)
+                except Exception as e:
+                    # 不让 worker 退出，也不让提问者一直等待 saved
+                    logger.error(f"Flush {len(records)} ask records failed: {e}")
+                    for record in records:
+                        record.fail(e)
+
+    async def _set_titles(self, records: list[AskRecord]):
+        async def set_title(record: AskRecord):
+            try:
+                await self.chatgpt_manager.set_conversation_title(record.conversation_id, record.new_title)
+            except Exception as e:
+                logger.warning(f"Set title of conversation {record.conversation_id} failed: {e}")
+
+        await asyncio.gather(*[set_title(record) for record in records
+                               if record.is_new_conv and record.conversation_id is not None
+                               and record.new_title is not None])
+
+    async def _flush(self, records: list[AskRecord]):
+        # 先写入数据库，使提问者可以尽快结束（见 AskRecord.saved），再请求上游设置标题
+        records = await self._save_with_retry(records)
+        if not records:
+            return
+
+        try:
+            await append_ask_messages(records)
+        except Exception as e:
+            logger.warning(f"Save ask messages to mirror failed: {e}")
+
+        for record in records:
+            if not record.saved.done():
+                record.saved.set_result(None)
+
+        await self._set_titles(records)
+
+        for record in records:
+            if record.title_future is not None:
+                self._generate_title(record)
+
+    async def _save_with_retry(self, records: list[AskRecord]) -> list[AskRecord]:
+        """
+        返回已写入数据库的记录；无法写入的记录的 saved 和 title_future 被设置为异常
+        只有数据库暂时不可用（如 database is locked）时重试，其它错误直接逐条提交
+        """
+        delay = self.retry_interval
+        for attempt in range(self.retry_times + 1):
+            try:
+                await self._save(records)
+                return records
+            except OperationalError as e:
+                logger.warning(f"Save {len(records)} ask records failed (attempt {attempt + 1}): {e}")
+            except Exception as e:
+                logger.warning(f"Save {len(records)} ask records failed: {e}")
+                break
+            if attempt < self.retry_times:
+                await asyncio.sleep(delay)
+                delay *= 2
+
+        # 逐条提交，一条有问题的记录不影响其它记录
+        saved = []
+        for record in records:
+            try:
+                await self._save([record])
+                saved.append(record)
+            except Exception as e:
+                logger.error(f"Save ask record of user {record.user_id} "
+                             f"(conversation {record.conversation_id}) failed: {e}")
+                record.fail(e)
+        return saved
+
+    async def _save(self, records: list[AskRecord]):
+        """在一个事务中写入新对话并更新已有对话"""
+        # 同一对话只保留最后一次的活跃时间和模型
+        active_conversations: dict[str, AskRecord] = {}
+        new_conversations = []
+        for record in records:
+            if record.is_new_conv:
+                # 上游未返回任何内容时没有新建对话
+                if record.conversation_id is not None:
+                    new_conversations.append(Conversation(conversation_id=record.conversation_id,
+                                                          title=record.new_title, user_id=record.user_id,
+                                                          model_name=record.model_name,
+                                                          account_name=record.account_name,
+                                                          create_time=record.finish_time,
+                                                          active_time=record.finish_time))
+            else:
+                active_conversations[record.conversation_id] = record
+
+        async with get_async_session_context() as session:
+            session.add_all(new_conversations)
+            conversation_table = Conversation.__table__
+            if active_conversations:
+                await session.execute(
+                    update(conversation_table)
+                    .where(conversation_table.c.conversation_id == bindparam("b_conversation_id"))
+                    .values(active_time=bindparam("b_active_time"), model_name=bindparam("b_model_name")),
+                    [{"b_conversation_id": record.conversation_id, "b_active_time": record.finish_time,
+                      "b_model_name": record.model_name} for record in active_conversations.values()]
+                )
+            await session.commit()
+        logger.debug(f"Saved {len(records)} ask records")
+
+    def _generate_title(self, record: AskRecord):
+        """对话已写入数据库，此时提交自动生成标题的任务"""
+        future = self.title_generator.submit(record.conversation_id, record.title_message_id)
+        if future is None:
+            record.title_future.set_exception(RuntimeError("title generation queue is full"))
+            return
+
+        def copy_result(f: asyncio.Future):
+            if record.title_future.done():
+                return
+            if f.cancelled():
+                record.title_future.cancel()
+            elif f.exception() is not None:
+                record.title_future.set_exception(f.exception())
+            else:
+                record.title_future.set_result(f.result())
+
+        future.add_done_callback(copy_result)
@@ -0,0 +1,202 @@
+import json
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Any
+
+
+class BaseCache(ABC):
+    """
+    异步键值缓存的公共接口，并统计命中/未命中次数
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+    @abstractmethod
+    async def _get(self, key: str) -> Any | None:
+        ...
+
+    @abstractmethod
+    async def set(self, key: str, value: Any):
+        ...
+
+    @abstractmethod
+    async def delete(self, key: str):
+        ...
+
+    @abstractmethod
+    async def clear(self):
+        ...
+
+    async def get(self, key: str) -> Any | None:
+        value = await self._get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    async def peek(self, key: str) -> Any | None:
+        """读取但不计入命中统计，用于写入前的更新"""
+        return await self._get(key)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "backend": self.__class__.__name__,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else None,
+        }
+
+
+class NullCache(BaseCache):
+    """
+    不缓存任何内容，用于关闭缓存
+    """
+
+    async def _get(self, key: str) -> Any | None:
+        return None
+
+    async def set(self, key: str, value: Any):
+        pass
+
+    async def delete(self, key: str):
+        pass
+
+    async def clear(self):
+        pass
+
+
+class MemoryCache(BaseCache):
+    """
+    进程内 LRU 缓存，超过 max_size 时淘汰最久未使用的项，超过 ttl 秒的项视为过期
+    """
+
+    def __init__(self, max_size: int = 256, ttl: float = 600):
+        super().__init__()
+        self.max_size = max_size
+        self.ttl = ttl
+        self.evictions = 0
+        # key -> (过期时间, value)
+        self.data: OrderedDict[str, tuple[float, Any]] = OrderedDict()
+
+    async def _get(self, key: str) -> Any | None:
+        item = self.data.get(key)
+        if item is None:
+            return None
+        expire_time, value = item
+        if expire_time < time.time():
+            del self.data[key]
+            return None
+        self.data.move_to_end(key)
+        return value
+
+    async def set(self, key: str, value: Any):
+        self.data[key] = (time.time() + self.ttl, value)
+        self.data.move_to_end(key)
+        while len(self.data) > self.max_size:
+            self.data.popitem(last=False)
+            self.evictions += 1
+
+    async def delete(self, key: str):
+        self.data.pop(key, None)
+
+    async def clear(self):
+        self.data.clear()
+
+    def stats(self) -> dict:
+        result = super().stats()
+        result.update(size=len(self.data), max_size=self.max_size, ttl=self.ttl, evictions=self.evictions)
+        return result
+
+
+class RedisCache(BaseCache):
+    """
+    使用 Redis 作为外部缓存，适用于多进程部署；需要额外安装 redis 包
+    """
+
+    def __init__(self, url: str = "redis://localhost:6379/0", ttl: float = 600, prefix: str = "cws:"):
+        super().__init__()
+        try:
+            import redis.asyncio as redis
+        except ImportError as e:
+            raise RuntimeError("Please install redis (pip install redis) to use the redis cache backend") from e
+        self.client = redis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+
+    async def _get(self, key: str) -> Any | None:
+        value = await self.client.get(self.prefix + key)
+        if value is None:
+            return None
+        return json.loads(value)
+
+    async def set(self, key: str, value: Any):
+        await self.client.set(self.prefix + key, json.dumps(value, ensure_ascii=False), ex=int(self.ttl))
+
+    async def delete(self, key: str):
+        await self.client.delete(self.prefix + key)
+
+    async def clear(self):
+        async for key in self.client.scan_iter(match=self.prefix + "*"):
+            await self.client.delete(key)
+
+    def stats(self) -> dict:
+        result = super().stats()
+        result.update(ttl=self.ttl)
+        return result
+
+
+def create_cache(cache_config: dict | None) -> BaseCache:
+    cache_config = cache_config or {}
+    backend = cache_config.get("backend", "memory")
+    if backend == "none":
+        return NullCache()
+    if backend == "memory":
+        return MemoryCache(max_size=cache_config.get("max_size", 256), ttl=cache_config.get("ttl", 600))
+    if backend == "redis":
+        return RedisCache(url=cache_config.get("redis_url", "redis://localhost:6379/0"),
+                          ttl=cache_config.get("ttl", 600),
+                          prefix=cache_config.get("prefix", "cws:"))
+    raise ValueError(f"Unknown cache backend: {backend}")
+
+
+class UserCache:
+    """
+    已验证的 token -> 用户的短期缓存，使鉴权不必每次解码 JWT 和查询数据库
+    用户信息变化（修改资料、额度、密码，扣除次数）时按用户失效：每个用户有一个版本号，缓存项的版本号落后即视为失效
+    """
+
+    def __init__(self, max_size: int = 10000, ttl: float = 60):
+        self.cache = MemoryCache(max_size=max_size, ttl=ttl)
+        self.versions: dict[int, int] = {}
+
+    async def get(self, token: str) -> Any | None:
+        item = await self.cache.get(token)
+        if item is None:
+            return None
+        expire_time, version, user = item
+        if version != self.get_version(user.id) or (expire_time is not None and expire_time < time.time()):
+            await self.cache.delete(token)
+            return None
+        return user
+
+    def get_version(self, user_id: int) -> int:
+        """应在读取数据库之前获取，避免读取期间的更新被缓存覆盖"""
+        return self.versions.get(user_id, 0)
+
+    async def set(self, token: str, user: Any, version: int, expire_time: float | None = None):
+        """expire_time 为 token 本身的过期时间"""
+        await self.cache.set(token, (expire_time, version, user))
+
+    def invalidate(self, user_id: int):
+        self.versions[user_id] = self.get_version(user_id) + 1
+
+    async def clear(self):
+        await self.cache.clear()
+
+    def stats(self) -> dict:
+        return self.cache.stats()
@@ -1,68 +1,619 @@
-from fastapi.encoders import jsonable_encoder
-from revChatGPT.V1 import AsyncChatbot
 import asyncio
+import contextlib
+import importlib.util
+import json
+import time
+import uuid
+
+import httpx
+from fastapi.encoders import jsonable_encoder
+from revChatGPT.V1 import AsyncChatbot, Error, ErrorType, BASE_URL
+from sqlalchemy import select, update
+
+from api.cache import create_cache, NullCache
+from api.circuit_breaker import create_circuit_breaker, is_upstream_failure
 from api.config import config
+from api.database import get_async_session_context
 from api.enums import ChatModels
+from api.exceptions import UpstreamUnavailableException, InvalidParamsException, ResourceNotFoundException
+from api.mirror import is_mirror_enabled
+from api.models import Conversation
 from utils.common import get_conversation_model
+from utils.logger import get_logger
 
+logger = get_logger(__name__)
 
-class ChatGPTManager:
-    def __init__(self):
+
+def create_http_transport() -> httpx.AsyncHTTPTransport:
+    """
+    所有账号共享的上游连接池，配置见 chatgpt_http
+    """
+    http_config = config.get("chatgpt_http") or {}
+    http2 = http_config.get("http2", False)
+    if http2 and importlib.util.find_spec("h2") is None:
+        logger.warning("HTTP/2 requires the h2 package (pip install h2), falling back to HTTP/1.1")
+        http2 = False
+    proxy = http_config.get("proxy")
+    return httpx.AsyncHTTPTransport(
+        http2=http2,
+        limits=httpx.Limits(
+            max_connections=http_config.get("max_connections", 50),
+            max_keepalive_connections=http_config.get("max_keepalive_connections", 20),
+            keepalive_expiry=http_config.get("keepalive_expiry", 60),
+        ),
+        proxy=httpx.Proxy(proxy) if proxy else None,
+        retries=http_config.get("connect_retries", 1),
+    )
+
+
+def get_http_timeout(read: float = None) -> httpx.Timeout:
+    """各阶段超时时间；read 为空时使用配置中的 read_timeout"""
+    http_config = config.get("chatgpt_http") or {}
+    return httpx.Timeout(
+        connect=http_config.get("connect_timeout", 10),
+        read=read if read is not None else http_config.get("read_timeout", 60),
+        write=http_config.get("write_timeout", 10),
+        pool=http_config.get("pool_timeout", 10),
+    )
+
+
+class ChatGPTAccount:
+    """
+    单个 ChatGPT 账号，包装一个 AsyncChatbot
+    running 表示当前正在该账号上进行的提问数量，最多为 max_concurrency
+    """
+
+    def __init__(self, name: str, access_token: str, paid: bool = False, max_concurrency: int = 1,
+                 transport: httpx.AsyncHTTPTransport = None):
+        self.name = name
+        self.paid = paid
         self.chatbot = AsyncChatbot({
-            "access_token": config.get("chatgpt_access_token"),
-            "paid": config.get("chatgpt_paid"),
+            "access_token": access_token,
+            "paid": paid,
         })
-        self.semaphore = asyncio.Semaphore(1)
+        if transport is not None:
+            # 替换 AsyncChatbot 自带的 client：使用共享连接池，并去掉 Connection: close 以复用连接
+            headers = self.chatbot.session.headers.copy()
+            headers.pop("Connection", None)
+            self.chatbot.session = httpx.AsyncClient(transport=transport, headers=headers,
+                                                     cookies=self.chatbot.session.cookies,
+                                                     timeout=get_http_timeout())
+        self.max_concurrency = max_concurrency
+        self.running = 0
 
     def is_busy(self):
-        return self.semaphore.locked()
+        return self.running >= self.max_concurrency
+
+    def can_use_model(self, model_name: ChatModels = None):
+        if model_name in [ChatModels.gpt4, ChatModels.paid]:
+            return self.paid
+        return True
+
+    def get_default_model(self) -> ChatModels:
+        return ChatModels.paid if self.paid else ChatModels.default
+
+    async def ask(self, message, conversation_id: str = None, parent_id: str = None,
+                  timeout=360, model_name: ChatModels = None):
+        """
+        与 AsyncChatbot.ask 的协议相同，但模型、conversation_id、parent_id 均为本次请求的局部状态，
+        不修改 chatbot 上的共享状态，因此同一账号上可以同时进行多个提问
+        返回的数据中 request_message_id / request_parent_id 为提问消息的 id 及其父消息 id，用于本地镜像
+        """
+        if parent_id is not None and conversation_id is None:
+            raise Error(source="User", message="conversation_id must be set once parent_id is set",
+                        code=ErrorType.USER_ERROR)
+        if conversation_id is not None and parent_id is None:
+            history = await self.chatbot.get_msg_history(conversation_id)
+            parent_id = history["current_node"]
+        if conversation_id is None and parent_id is None:
+            parent_id = str(uuid.uuid4())
+        if model_name is None or model_name == ChatModels.unknown:
+            model_name = self.get_default_model()
+
+        request_message_id = str(uuid.uuid4())
+        data = {
+            "action": "next",
+            "messages": [
+                {
+                    "id": request_message_id,
+                    "role": "user",
+                    "content": {"content_type": "text", "parts": [message]},
+                },
+            ],
+            "conversation_id": conversation_id,
+            "parent_message_id": parent_id,
+            "model": model_name.value,
+        }
+        async with self.chatbot.session.stream(
+                method="POST",
+                url=f"{BASE_URL}conversation",
+                json=data,
+                timeout=get_http_timeout(read=timeout),
+        ) as response:
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                if not line:
+                    continue
+                if line.startswith("data: "):
+                    line = line[6:]
+                if line == "[DONE]":
+                    break
+                try:
+                    line = json.loads(line)
+                except json.decoder.JSONDecodeError:
+                    continue
+                try:
+                    reply = line["message"]
+                    content = reply["content"]
+                except (TypeError, KeyError):
+                    raise Exception(f"Field missing. Details: {str(line)}")
+                yield {
+                    "message": content["parts"][0],
+                    "conversation_id": line["conversation_id"],
+                    "parent_id": reply["id"],
+                    "model": reply["metadata"].get("model_slug"),
+                    "create_time": reply.get("create_time"),
+                    "request_message_id": request_message_id,
+                    "request_parent_id": parent_id,
+                }
+
+    async def gen_title(self, conversation_id: str, message_id: str) -> dict:
+        """AsyncChatbot.gen_title 不返回结果，这里直接请求并返回 {title} 或 {message}"""
+        response = await self.chatbot.session.post(
+            f"{BASE_URL}conversation/gen_title/{conversation_id}",
+            json={"message_id": message_id, "model": "text-davinci-002-render"},
+        )
+        response.raise_for_status()
+        return response.json()
+
+
+def load_accounts_from_config(transport: httpx.AsyncHTTPTransport = None) -> list[ChatGPTAccount]:
+    """
+    从 chatgpt_accounts 读取账号列表；若未配置，则使用 chatgpt_access_token 和 chatgpt_paid 作为唯一账号
+    """
+    accounts_config = config.get("chatgpt_accounts") or [{
+        "name": "default",
+        "access_token": config.get("chatgpt_access_token"),
+        "paid": config.get("chatgpt_paid", False),
+    }]
+    accounts = []
+    for index, account_config in enumerate(accounts_config):
+        accounts.append(ChatGPTAccount(
+            name=account_config.get("name") or f"account-{index}",
+            access_token=account_config.get("access_token"),
+            paid=account_config.get("paid", False),
+            max_concurrency=account_config.get("max_concurrency", config.get("chatgpt_max_concurrency", 1)),
+            transport=transport,
+        ))
+    return accounts
+
+
+class AskTicket:
+    """
+    提问队列中的一个排队请求
+    当 account 被分配后，event 被设置，持有者即可在该账号上提问
+    """
+
+    def __init__(self, user_id: int, priority: int, seq: int, model_name: ChatModels = None,
+                 conversation_id: str = None, owner: "ChatGPTAccount" = None):
+        self.user_id = user_id
+        self.priority = priority
+        self.seq = seq
+        self.model_name = model_name
+        self.conversation_id = conversation_id
+        # 已有对话所属的账号，只能分配到该账号
+        self.owner = owner
+        self.enqueue_time = time.time()
+        self.start_time: float | None = None
+        self.account: ChatGPTAccount | None = None
+        # 在熔断器 half_open 时被分配，占用了一个探测名额；该名额同时用于本次的上游调用
+        self.probe_round: float | None = None
+        # 排队期间上游熔断时设置，wait 会抛出该异常
+        self.error: Exception | None = None
+        self.event = asyncio.Event()
+
+    def is_ready(self):
+        return self.account is not None
+
+    async def wait(self, timeout: float = None) -> bool:
+        """等待被分配账号，超时返回 False"""
+        try:
+            await asyncio.wait_for(self.event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        if self.error is not None:
+            raise self.error
+        return self.is_ready()
+
+
+def get_user_priority(user) -> int:
+    """
+    根据 ask_queue_priority 计算用户优先级，数值越小越优先
+    可配置的键：superuser / gpt4 / paid / default，用户取所满足条件中的最小值
+    """
+    priority_config = config.get("ask_queue_priority") or {"superuser": 0, "default": 1}
+    default = priority_config.get("default", 1)
+    priorities = [default]
+    if user.is_superuser and "superuser" in priority_config:
+        priorities.append(priority_config["superuser"])
+    if user.can_use_gpt4 and "gpt4" in priority_config:
+        priorities.append(priority_config["gpt4"])
+    if user.can_use_paid and "paid" in priority_config:
+        priorities.append(priority_config["paid"])
+    return min(priorities)
+
+
+class ChatGPTManager:
+    """
+    管理多个 ChatGPT 账号：
+    - 新对话被分配到空闲且支持所选模型的账号上（优先选择负载最低的账号）
+    - 已有对话固定在创建它的账号上（记录在 Conversation.account_name），后续提问会等待该账号空闲
+    - 排队顺序：先按优先级，再按用户近期的使用量（公平分享，使用少的用户优先），最后按到达顺序
+    """
+
+    def __init__(self):
+        self.transport = create_http_transport()
+        self.accounts = load_accounts_from_config(self.transport)
+        # conversation_id -> ChatGPTAccount，数据库中 Conversation.account_name 的内存缓存
+        self.conversation_accounts: dict[str, ChatGPTAccount] = {}
+        self.waiting_tickets: list[AskTicket] = []
+        self.ticket_seq = 0
+        # user_id -> (使用量, 上次更新时间)，使用量按半衰期衰减
+        self.user_usage: dict[int, tuple[float, float]] = {}
+        self.usage_half_life = config.get("ask_queue_fair_share_half_life", 600)
+        # 平均每次提问占用账号的时间，用于估计排队时间
+        self.average_ask_duration = config.get("ask_queue_initial_duration_estimate", 30)
+        # 用户提问的平均排队时间和正在进行的提问数，不含后台任务
+        self.average_wait_time = 0.0
+        self.asking_count = 0
+        # 对话历史缓存，在提问、修改标题、删除对话时失效或更新
+        # 启用本地镜像时历史记录由镜像提供，回填镜像必须读取上游，缓存不会被读取，因此不创建
+        self.conversation_cache = NullCache() if is_mirror_enabled() \
+            else create_cache(config.get("conversation_cache"))
+        # 上游熔断器，熔断时立即让排队中的请求失败，可以重新探测时再次分配排队中的请求
+        self.circuit_breaker = create_circuit_breaker(on_open=self._fail_waiting_tickets,
+                                                      on_half_open=lambda: self._schedule_dispatch(0))
+        self.dispatch_timer: asyncio.TimerHandle | None = None
+
+    async def warm_up(self):
+        """预先建立到上游的连接（TCP/TLS），使首次提问不必等待连接建立"""
+        connections = (config.get("chatgpt_http") or {}).get("warm_up_connections", 2)
+
+        async def open_connection(account: ChatGPTAccount):
+            try:
+                await account.chatbot.session.head(BASE_URL)
+            except httpx.HTTPError as e:
+                logger.warning(f"Warm up connection of account {account.name} failed: {e}")
+
+        await asyncio.gather(*[open_connection(account) for account in self.accounts for _ in range(connections)])
+
+    async def close(self):
+        await self.transport.aclose()
+
+    def is_busy(self):
+        return all(account.is_busy() for account in self.accounts)
+
+    def is_model_available(self, model_name: ChatModels):
+        return any(account.can_use_model(model_name) for account in self.accounts)
+
+    def get_account_by_name(self, name: str | None) -> ChatGPTAccount | None:
+        return next((account for account in self.accounts if account.name == name), None)
+
+    async def resolve_account(self, conversation_id: str, account_name: str = None) -> ChatGPTAccount:
+        """
+        返回对话所属的账号：依次查找内存缓存、account_name（为空时查询数据库）
+        数据库中没有记录（如旧版本创建的对话）且有多个账号时，逐个账号向上游查询并保存结果
+        """
+        account = self.conversation_accounts.get(conversation_id)
+        if account is not None:
+            return account
+        if account_name is None:
+            async with get_async_session_context() as session:
+                account_name = (await session.execute(
+                    select(Conversation.account_name).where(Conversation.conversation_id == conversation_id)
+                )).scalar_one_or_none()
+        account = self.get_account_by_name(account_name)
+        if account is None:
+            if len(self.accounts) == 1:
+                account = self.accounts[0]
+            else:
+                account = await self._locate_account(conversation_id)
+        self.conversation_accounts[conversation_id] = account
+        return account
+
+    async def _locate_account(self, conversation_id: str) -> ChatGPTAccount:
+        for account in self.accounts:
+            try:
+                # 其它账号上的对话会返回 404，不经过熔断器
+                await account.chatbot.get_msg_history(conversation_id)
+            except Exception as e:
+                logger.debug(f"Conversation {conversation_id} not found on account {account.name}: {e}")
+                continue
+            logger.info(f"Located conversation {conversation_id} on account {account.name}")
+            await self.save_conversation_account(conversation_id, account)
+            return account
+        raise ResourceNotFoundException("errors.conversationNotFound")
+
+    async def save_conversation_account(self, conversation_id: str, account: ChatGPTAccount):
+        self.conversation_accounts[conversation_id] = account
+        async with get_async_session_context() as session:
+            await session.execute(update(Conversation).where(Conversation.conversation_id == conversation_id)
+                                  .values(account_name=account.name))
+            await session.commit()
+
+    def _select_account(self, model_name: ChatModels = None, owner: ChatGPTAccount = None) -> ChatGPTAccount | None:
+        if owner is not None:
+            return None if owner.is_busy() or not owner.can_use_model(model_name) else owner
+        candidates = [account for account in self.accounts
+                      if account.can_use_model(model_name) and not account.is_busy()]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda account: account.running / account.max_concurrency)
+
+    def _get_user_usage(self, user_id: int, now: float = None) -> float:
+        usage, last_update = self.user_usage.get(user_id, (0.0, 0.0))
+        now = now or time.time()
+        return usage * 0.5 ** ((now - last_update) / self.usage_half_life)
+
+    def _add_user_usage(self, user_id: int, amount: float = 1.0):
+        now = time.time()
+        self.user_usage[user_id] = (self._get_user_usage(user_id, now) + amount, now)
+
+    def _sort_waiting_tickets(self):
+        now = time.time()
+        self.waiting_tickets.sort(
+            key=lambda ticket: (ticket.priority, self._get_user_usage(ticket.user_id, now), ticket.seq))
+
+    def _fail_waiting_tickets(self):
+        for ticket in self.waiting_tickets:
+            ticket.error = UpstreamUnavailableException("upstream circuit breaker is open")
+            ticket.event.set()
+        self.waiting_tickets.clear()
+
+    def _schedule_dispatch(self, delay: float):
+        """delay 秒后重新分配；熔断器状态是在调用时才更新的，需要定时触发"""
+        if not self.waiting_tickets:
+            return
+        loop = asyncio.get_running_loop()
+        if self.dispatch_timer is not None:
+            if self.dispatch_timer.when() <= loop.time() + delay:
+                return
+            self.dispatch_timer.cancel()
+
+        def run():
+            self.dispatch_timer = None
+            self._dispatch()
+
+        self.dispatch_timer = loop.call_later(delay, run)
+
+    def _dispatch(self):
+        """按排队顺序为等待中的请求分配空闲账号；无法分配的请求不会阻塞后面的请求"""
+        self._sort_waiting_tickets()
+        for ticket in list(self.waiting_tickets):
+            account = self._select_account(ticket.model_name, ticket.owner)
+            if account is None:
+                continue
+            # 熔断器半开时只放行少量探测请求，其余继续排队，到可以重新探测时再分配
+            probe_round = self.circuit_breaker.get_probe_round()
+            if not self.circuit_breaker.try_acquire():
+                self._schedule_dispatch(self.circuit_breaker.get_retry_delay())
+                break
+            account.running += 1
+            ticket.account = account
+            ticket.probe_round = probe_round
+            ticket.start_time = time.time()
+            self.waiting_tickets.remove(ticket)
+            if ticket.user_id is not None:
+                self.asking_count += 1
+                wait_time = ticket.start_time - ticket.enqueue_time
+                self.average_wait_time = 0.8 * self.average_wait_time + 0.2 * wait_time
+            self._add_user_usage(ticket.user_id)
+            ticket.event.set()
+
+    def enqueue(self, user=None, model_name: ChatModels = None, conversation_id: str = None,
+                priority: int = None, owner: ChatGPTAccount = None) -> AskTicket:
+        """
+        user 为空表示后台任务（如生成标题），此时需指定 priority
+        owner 为已有对话所属的账号，见 resolve_account
+        """
+        if self.circuit_breaker.is_open():
+            raise UpstreamUnavailableException("upstream circuit breaker is open")
+        if owner is not None and not owner.can_use_model(model_name):
+            # 否则请求会一直排队
+            raise InvalidParamsException("errors.paidModelNotAvailable")
+        self.ticket_seq += 1
+        if priority is None:
+            priority = get_user_priority(user)
+        ticket = AskTicket(user.id if user else None, priority, self.ticket_seq, model_name, conversation_id, owner)
+        self.waiting_tickets.append(ticket)
+        self._dispatch()
+        return ticket
+
+    def release(self, ticket: AskTicket):
+        """释放请求占用的账号；若请求仍在排队则将其移出队列"""
+        if ticket.account is None:
+            if ticket in self.waiting_tickets:
+                self.waiting_tickets.remove(ticket)
+            return
+        ticket.account.running -= 1
+        if ticket.user_id is not None:
+            self.asking_count -= 1
+        duration = time.time() - ticket.start_time
+        self.average_ask_duration = 0.8 * self.average_ask_duration + 0.2 * duration
+        ticket.account = None
+        # 探测调用没有产生结果（未发起或被取消）时归还名额
+        self.circuit_breaker.release_probe(ticket.probe_round)
+        ticket.probe_round = None
+        self._dispatch()
+
+    def get_queue_stats(self) -> dict:
+        """队列统计，不含后台任务（如生成标题）；耗时只与排队人数有关"""
+        waiting_count_by_model = {}
+        for ticket in self.waiting_tickets:
+            if ticket.user_id is None:
+                continue
+            model_name = ticket.model_name.value if ticket.model_name else ChatModels.unknown.value
+            waiting_count_by_model[model_name] = waiting_count_by_model.get(model_name, 0) + 1
+        return {
+            "waiting_count": sum(waiting_count_by_model.values()),
+            "waiting_count_by_model": waiting_count_by_model,
+            "asking_count": self.asking_count,
+            "average_wait_time": round(self.average_wait_time, 1),
+            "average_ask_duration": round(self.average_ask_duration, 1),
+        }
+
+    def get_queue_position(self, ticket: AskTicket) -> int:
+        """返回请求在队列中的位置（从 1 开始），已分配账号时返回 0"""
+        if ticket.is_ready() or ticket not in self.waiting_tickets:
+            return 0
+        self._sort_waiting_tickets()
+        return self.waiting_tickets.index(ticket) + 1
+
+    def get_queue_eta(self, ticket: AskTicket) -> float:
+        """粗略估计还需等待的秒数"""
+        position = self.get_queue_position(ticket)
+        capacity = sum(account.max_concurrency for account in self.accounts)
+        return round(position * self.average_ask_duration / capacity, 1)
+
+    @contextlib.asynccontextmanager
+    async def queue_ask(self, user=None, model_name: ChatModels = None, conversation_id: str = None,
+                        priority: int = None):
+        """加入提问队列，退出时释放占用的账号或取消排队"""
+        owner = await self.resolve_account(conversation_id) if conversation_id is not None else None
+        ticket = self.enqueue(user, model_name, conversation_id, priority, owner)
+        try:
+            yield ticket
+        finally:
+            self.release(ticket)
+
+    async def _call_upstream(self, coro, ticket: AskTicket = None):
+        """
+        通过熔断器调用上游，并记录结果和耗时
+        ticket 为已分配账号的排队请求时，分配时已获得熔断器的许可，不再重复获取
+        """
+        if (ticket is None or not ticket.is_ready()) and not self.circuit_breaker.try_acquire():
+            coro.close()
+            raise UpstreamUnavailableException("upstream circuit breaker is open")
+        start_time = time.time()
+        try:
+            result = await coro
+        except asyncio.CancelledError:
+            self.circuit_breaker.record(None)
+            raise
+        except Exception as e:
+            self.circuit_breaker.record(not is_upstream_failure(e), time.time() - start_time)
+            raise
+        self.circuit_breaker.record(True, time.time() - start_time)
+        return result
 
     async def get_conversations(self):
-        conversations = await self.chatbot.get_conversations()
+        results = await asyncio.gather(
+            *[self._call_upstream(account.chatbot.get_conversations()) for account in self.accounts],
+            return_exceptions=True)
+        conversations = []
+        for account, result in zip(self.accounts, results):
+            if isinstance(result, Exception):
+                # 只有一个账号时保持原有行为，直接抛出异常
+                if len(self.accounts) == 1:
+                    raise result
+                logger.warning(f"Fetch conversations of account {account.name} failed: {result}")
+                continue
+            for conv in result:
+                self.conversation_accounts[conv["id"]] = account
+            conversations.extend(result)
         return conversations
 
-    async def get_conversation_messages(self, conversation_id: str):
-        # TODO: 使用 redis 缓存
-        messages = await self.chatbot.get_msg_history(conversation_id)
+    async def get_conversations_page(self, account: ChatGPTAccount, offset: int, limit: int):
+        """分页获取单个账号的对话（按更新时间倒序），并记录对话所属的账号"""
+        result = await self._call_upstream(account.chatbot.get_conversations(offset, limit))
+        for conv in result:
+            self.conversation_accounts[conv["id"]] = account
+        return result
+
+    @staticmethod
+    def _get_cache_key(conversation_id: str):
+        return f"conversation:{conversation_id}"
+
+    async def invalidate_conversation_cache(self, conversation_id: str):
+        await self.conversation_cache.delete(self._get_cache_key(conversation_id))
+
+    async def get_conversation_messages(self, conversation_id: str, use_cache: bool = True, account_name: str = None):
+        """
+        use_cache 为 False 时既不读取也不写入缓存，用于导出等一次性的批量读取
+        account_name 为已知的对话所属账号，可省去一次数据库查询
+        """
+        if use_cache:
+            messages = await self.conversation_cache.get(self._get_cache_key(conversation_id))
+            if messages is not None:
+                return messages
+        account = await self.resolve_account(conversation_id, account_name)
+        messages = await self._call_upstream(account.chatbot.get_msg_history(conversation_id))
         messages = jsonable_encoder(messages)
         model_name = get_conversation_model(messages)
         messages["model_name"] = model_name or ChatModels.unknown.value
+        if use_cache:
+            await self.conversation_cache.set(self._get_cache_key(conversation_id), messages)
         return messages
 
     async def clear_conversations(self):
-        await self.chatbot.clear_conversations()
+        for account in self.accounts:
+            await self._call_upstream(account.chatbot.clear_conversations())
+        self.conversation_accounts.clear()
+        await self.conversation_cache.clear()
 
-    def ask(self, message, conversation_id: str = None, parent_id: str = None,
-            timeout=360, model_name: ChatModels=None):
-        if model_name is not None and model_name != ChatModels.unknown:
-            self.chatbot.config["model"] = model_name.value
-        return self.chatbot.ask(message, conversation_id, parent_id, timeout)
+    async def ask(self, account: ChatGPTAccount, message, conversation_id: str = None, parent_id: str = None,
+                  timeout=360, model_name: ChatModels = None):
+        """
+        在排队分配到的账号上提问，并记录新对话所属的账号
+        熔断器以首个回复的耗时作为本次调用的延迟
+        """
+        start_time = time.time()
+        first_reply_duration = None
+        try:
+            async for data in account.ask(message, conversation_id, parent_id, timeout, model_name):
+                if first_reply_duration is None:
+                    first_reply_duration = time.time() - start_time
+                if conversation_id is None and data.get("conversation_id"):
+                    conversation_id = data["conversation_id"]
+                    self.conversation_accounts[conversation_id] = account
+                yield data
+            self.circuit_breaker.record(True, first_reply_duration or time.time() - start_time)
+        except (asyncio.CancelledError, GeneratorExit):
+            self.circuit_breaker.record(None)
+            raise
+        except Exception as e:
+            self.circuit_breaker.record(not is_upstream_failure(e), time.time() - start_time)
+            raise
+        finally:
+            if conversation_id is not None:
+                await self.invalidate_conversation_cache(conversation_id)
 
     async def delete_conversation(self, conversation_id: str):
-        await self.chatbot.delete_conversation(conversation_id)
+        await self.invalidate_conversation_cache(conversation_id)
+        account = await self.resolve_account(conversation_id)
+        await self._call_upstream(account.chatbot.delete_conversation(conversation_id))
+        self.conversation_accounts.pop(conversation_id, None)
 
     async def set_conversation_title(self, conversation_id: str, title: str):
         """Hack change_title to set title in utf-8"""
-        await self.chatbot.change_title(conversation_id, title)
+        account = await self.resolve_account(conversation_id)
+        await self._call_upstream(account.chatbot.change_title(conversation_id, title))
+        # 直接更新缓存中的标题，避免重新请求对话历史
+        cache_key = self._get_cache_key(conversation_id)
+        messages = await self.conversation_cache.peek(cache_key)
+        if messages is not None:
+            messages["title"] = title
+            await self.conversation_cache.set(cache_key, messages)
         # url = BASE_URL + f"api/conversation/{conversation_id}"
         # data = json.dumps({"title": title}, ensure_ascii=False).encode("utf-8")
         # response = self.chatbot.session.patch(url, data=data)
         # chatbot_check_response(response)
 
-    async def generate_conversation_title(self, conversation_id: str, message_id: str):
-        """Hack gen_title to get title"""
-        await self.chatbot.gen_title(conversation_id, message_id)
-        # url = BASE_URL + f"api/conversation/gen_title/{conversation_id}"
-        # response = self.chatbot.session.post(
-        #     url,
-        #     data=json.dumps(
-        #         {"message_id": message_id, "model": "text-davinci-002-render"},
-        #     ),
-        # )
-        # chatbot_check_response(response)
-        # return response.json()
-
-    def reset_chat(self):
-        self.chatbot.reset_chat()
-        if self.chatbot.config.get("model"):
-            self.chatbot.config["model"] = None
+    async def generate_conversation_title(self, conversation_id: str, message_id: str,
+                                          ticket: AskTicket = None) -> dict:
+        """生成标题，返回 {title} 或 {message}；上游会同时保存该标题。ticket 为排队分配到的请求"""
+        account = ticket.account if ticket is not None and ticket.is_ready() \
+            else await self.resolve_account(conversation_id)
+        result = await self._call_upstream(account.gen_title(conversation_id, message_id), ticket)
+        await self.invalidate_conversation_cache(conversation_id)
+        return result
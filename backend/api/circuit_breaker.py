@@ -0,0 +1,157 @@
+import time
+from collections import deque
+from typing import Callable
+
+import httpx
+from revChatGPT.V1 import Error as ChatGPTError
+
+from api.config import config
+from api.enums import CircuitState
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+
+def is_upstream_failure(e: BaseException) -> bool:
+    """判断异常是否说明上游不可用；404 等客户端错误不计入"""
+    if isinstance(e, httpx.HTTPStatusError):
+        return e.response.status_code >= 500 or e.response.status_code == 429
+    return isinstance(e, (httpx.TransportError, ChatGPTError))
+
+
+class CircuitBreaker:
+    """
+    上游熔断器：
+    - closed：统计最近 window 秒内的调用，失败（或慢调用）比例超过阈值时进入 open
+    - open：直接拒绝所有调用，open_duration 秒后进入 half_open
+    - half_open：只放行 half_open_probes 个探测调用，成功则 closed，失败则重新 open
+    on_half_open 在可以重新探测时调用（进入 half_open，或探测长时间没有结果而重置）
+    """
+
+    def __init__(self, window: float = 60, min_requests: int = 5, failure_rate_threshold: float = 0.5,
+                 slow_call_threshold: float = 30, open_duration: float = 30, half_open_probes: int = 1,
+                 on_open: Callable[[], None] = None, on_half_open: Callable[[], None] = None):
+        self.window = window
+        self.min_requests = min_requests
+        self.failure_rate_threshold = failure_rate_threshold
+        self.slow_call_threshold = slow_call_threshold
+        self.open_duration = open_duration
+        self.half_open_probes = half_open_probes
+        self.on_open = on_open
+        self.on_half_open = on_half_open
+
+        self.state = CircuitState.closed
+        self.state_change_time = time.time()
+        self.probes_started = 0
+        # (时间, 是否失败, 耗时)
+        self.calls: deque[tuple[float, bool, float]] = deque()
+
+    def _set_state(self, state: CircuitState):
+        if state == self.state:
+            return
+        logger.warning(f"Upstream circuit breaker: {self.state.value} -> {state.value}")
+        self.state = state
+        self.state_change_time = time.time()
+        self.probes_started = 0
+        if state == CircuitState.open and self.on_open is not None:
+            self.on_open()
+        if state == CircuitState.half_open and self.on_half_open is not None:
+            self.on_half_open()
+
+    def _update_state(self):
+        now = time.time()
+        if self.state == CircuitState.open and now - self.state_change_time >= self.open_duration:
+            self._set_state(CircuitState.half_open)
+        elif self.state == CircuitState.half_open and now - self.state_change_time >= self.open_duration:
+            # 探测调用长时间没有结果（例如被客户端取消），允许重新探测
+            self.state_change_time = now
+            self.probes_started = 0
+            if self.on_half_open is not None:
+                self.on_half_open()
+
+    def _trim(self):
+        expire_time = time.time() - self.window
+        while self.calls and self.calls[0][0] < expire_time:
+            self.calls.popleft()
+
+    def is_open(self) -> bool:
+        self._update_state()
+        return self.state == CircuitState.open
+
+    def try_acquire(self) -> bool:
+        """是否允许发起一次上游调用"""
+        self._update_state()
+        if self.state == CircuitState.closed:
+            return True
+        if self.state == CircuitState.half_open and self.probes_started < self.half_open_probes:
+            self.probes_started += 1
+            return True
+        return False
+
+    def get_probe_round(self) -> float | None:
+        """half_open 时返回本轮探测的标识，用于 release_probe"""
+        self._update_state()
+        return self.state_change_time if self.state == CircuitState.half_open else None
+
+    def release_probe(self, probe_round: float | None):
+        """
+        归还一个没有产生结果的探测名额（例如分配后请求方已断开）
+        本轮探测已有结果时状态已改变，不需要归还
+        """
+        if probe_round is None or self.state != CircuitState.half_open or self.state_change_time != probe_round:
+            return
+        if self.probes_started > 0:
+            self.probes_started -= 1
+            if self.on_half_open is not None:
+                self.on_half_open()
+
+    def get_retry_delay(self) -> float:
+        """距离下一次可能允许调用（进入 half_open 或重置探测）的秒数"""
+        if self.state == CircuitState.closed:
+            return 0
+        return max(0.0, self.state_change_time + self.open_duration - time.time())
+
+    def record(self, success: bool | None, duration: float = 0):
+        """
+        记录一次调用的结果；success 为 None 表示调用被中途取消，不计入统计
+        """
+        if success is None:
+            return
+        failed = not success or duration > self.slow_call_threshold
+        if self.state == CircuitState.half_open:
+            self._set_state(CircuitState.open if failed else CircuitState.closed)
+            if not failed:
+                self.calls.clear()
+            return
+        self.calls.append((time.time(), failed, duration))
+        self._trim()
+        if self.state == CircuitState.closed and len(self.calls) >= self.min_requests:
+            failures = sum(1 for call in self.calls if call[1])
+            if failures / len(self.calls) >= self.failure_rate_threshold:
+                self._set_state(CircuitState.open)
+
+    def stats(self) -> dict:
+        self._update_state()
+        self._trim()
+        failures = sum(1 for call in self.calls if call[1])
+        return {
+            "state": self.state.value,
+            "calls": len(self.calls),
+            "failures": failures,
+            "average_duration": sum(call[2] for call in self.calls) / len(self.calls) if self.calls else None,
+        }
+
+
+def create_circuit_breaker(on_open: Callable[[], None] = None,
+                           on_half_open: Callable[[], None] = None) -> CircuitBreaker:
+    breaker_config = config.get("chatgpt_circuit_breaker") or {}
+    return CircuitBreaker(
+        window=breaker_config.get("window", 60),
+        min_requests=breaker_config.get("min_requests", 5),
+        failure_rate_threshold=breaker_config.get("failure_rate_threshold", 0.5),
+        slow_call_threshold=breaker_config.get("slow_call_threshold", 30),
+        open_duration=breaker_config.get("open_duration", 30),
+        half_open_probes=breaker_config.get("half_open_probes", 1),
+        on_open=on_open,
+        on_half_open=on_half_open,
+    )
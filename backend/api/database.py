@@ -41,6 +41,28 @@ def run_ensure_version(conn, cfg):
     command.ensure_version(cfg)
 
 
+def create_missing_indexes(conn):
+    # create_all 不会为已存在的表添加新定义的索引
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(conn, checkfirst=True)
+
+
+def create_missing_columns(conn):
+    # create_all 不会为已存在的表添加新定义的列；只补充可为空的列，其它变更需要迁移
+    inspector = sqlalchemy.inspect(conn)
+    for table in Base.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing or not column.nullable:
+                continue
+            column_type = column.type.compile(dialect=conn.dialect)
+            conn.execute(sqlalchemy.text(f'ALTER TABLE "{table.name}" ADD COLUMN "{column.name}" {column_type}'))
+            logger.info(f"added column {table.name}.{column.name}")
+
+
 async def create_db_and_tables():
     # 如果数据库不存在则创建数据库（数据表）；若有更新，则执行迁移
     # https://alembic.sqlalchemy.org/en/latest/autogenerate.html
@@ -61,6 +83,11 @@ async def create_db_and_tables():
             return
         else:
             await conn.run_sync(run_ensure_version, alembic_cfg)
+            # 创建新增的数据表、列和索引（已存在的不受影响）
+            await conn.run_sync(Base.metadata.create_all)
+            await conn.run_sync(create_missing_columns)
+            await conn.run_sync(create_missing_indexes)
+            await conn.commit()
 
         if config.get("run_migration", False):
             try:
@@ -12,3 +12,9 @@ class ChatModels(enum.Enum):
     default = "text-davinci-002-render-sha"
     paid = "text-davinci-002-render-paid"
     unknown = ""
+
+
+class CircuitState(enum.Enum):
+    closed = "closed"
+    open = "open"
+    half_open = "half_open"
@@ -0,0 +1,90 @@
+import asyncio
+from collections import deque
+from datetime import datetime
+from typing import AsyncIterator, Literal
+
+from fastapi.encoders import jsonable_encoder
+from sqlalchemy import select
+
+from api.config import config
+from api.database import get_async_session_context
+from api.mirror import load_conversation_history
+from api.models import Conversation
+from api.schema import ConversationSchema
+
+# auto: 优先使用完整的本地镜像，否则从上游获取；mirror: 只使用本地镜像；upstream: 只从上游获取
+ExportSource = Literal["auto", "mirror", "upstream"]
+
+
+async def _load_item(chatgpt_manager, conversation: Conversation, source: ExportSource) -> dict:
+    item = {
+        "cursor": conversation.id,
+        "conversation": jsonable_encoder({field: getattr(conversation, field)
+                                          for field in ConversationSchema.__fields__}),
+        "history": None,
+        "error": None,
+    }
+    try:
+        history = None
+        if source != "upstream":
+            history = await load_conversation_history(conversation, allow_stale=source == "mirror")
+        if history is None and source != "mirror":
+            history = await chatgpt_manager.get_conversation_messages(conversation.conversation_id, use_cache=False,
+                                                                      account_name=conversation.account_name)
+        if history is None:
+            item["error"] = "conversation is not mirrored locally"
+        item["history"] = history
+    except Exception as e:
+        item["error"] = str(e)
+    return item
+
+
+async def export_conversations(chatgpt_manager, source: ExportSource = "auto", user_id: int = None,
+                               is_valid: bool = None, start_time: datetime = None, end_time: datetime = None,
+                               cursor: int = None, limit: int = None,
+                               concurrency: int = None) -> AsyncIterator[dict]:
+    """
+    按 id 顺序逐个返回对话及其历史记录：{ cursor, conversation, history, error }
+    - 对话分页读取，同时最多 concurrency 个对话在获取历史记录，内存占用与导出总量无关
+    - 获取失败的对话 history 为 null，error 为原因
+    - 传入上次最后一条的 cursor 可以继续导出
+    """
+    concurrency = concurrency or config.get("export_concurrency", 4)
+    page_size = config.get("export_page_size", 100)
+    filters = []
+    if user_id is not None:
+        filters.append(Conversation.user_id == user_id)
+    if is_valid is not None:
+        filters.append(Conversation.is_valid == is_valid)
+    if start_time is not None:
+        filters.append(Conversation.active_time >= start_time)
+    if end_time is not None:
+        filters.append(Conversation.active_time < end_time)
+
+    # 按顺序输出；队列中的任务即为正在进行的请求
+    pending: deque[asyncio.Task] = deque()
+    exported = 0
+    try:
+        while limit is None or exported + len(pending) < limit:
+            page_filters = list(filters)
+            if cursor is not None:
+                page_filters.append(Conversation.id > cursor)
+            page_limit = page_size if limit is None else min(page_size, limit - exported - len(pending))
+            async with get_async_session_context() as session:
+                r = await session.execute(
+                    select(Conversation).where(*page_filters).order_by(Conversation.id).limit(page_limit))
+                conversations = r.scalars().all()
+            if not conversations:
+                break
+            cursor = conversations[-1].id
+            for conversation in conversations:
+                pending.append(asyncio.create_task(_load_item(chatgpt_manager, conversation, source)))
+                if len(pending) >= concurrency:
+                    yield await pending.popleft()
+                    exported += 1
+        while pending:
+            yield await pending.popleft()
+            exported += 1
+    finally:
+        for task in pending:
+            task.cancel()
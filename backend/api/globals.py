@@ -1,7 +1,39 @@
+from api.activity import ActivityTracker
+from api.bookkeeper import AskBookkeeper
+from api.cache import UserCache
 from api.chatgpt import ChatGPTManager
+from api.password import PasswordHasher, LoginThrottle
+from api.config import config
+from api.presence import PresenceRegistry
+from api.quota import QuotaLedger, AskRateLimiter
+from api.reconciler import ConversationReconciler
+from api.streaming import ReplyRegistry
+from api.title_generator import TitleGenerator
 
 chatgpt_manager = ChatGPTManager()
 
+title_generator = TitleGenerator(chatgpt_manager)
+
+user_cache = UserCache(max_size=config.get("auth_cache_max_size", 10000), ttl=config.get("auth_cache_ttl", 60))
+
+ask_bookkeeper = AskBookkeeper(chatgpt_manager, title_generator)
+
+quota_ledger = QuotaLedger(user_cache)
+
+ask_rate_limiter = AskRateLimiter()
+
+reply_registry = ReplyRegistry()
+
+activity_tracker = ActivityTracker()
+
+password_hasher = PasswordHasher()
+
+login_throttle = LoginThrottle()
+
+presence = PresenceRegistry()
+
+conversation_reconciler = ConversationReconciler(chatgpt_manager)
+
 reverse_proxy_log_file = None
 
 reverse_proxy_process = None
@@ -0,0 +1,205 @@
+import time
+from datetime import datetime
+
+from sqlalchemy import select, delete, insert
+
+from api.config import config
+from api.database import get_async_session_context
+from api.enums import ChatModels
+from api.models import Conversation, ConversationMessage, ConversationMirror
+from utils.common import get_conversation_model
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+
+def is_mirror_enabled() -> bool:
+    return config.get("enable_conversation_mirror", True)
+
+
+def _get_timestamp(value) -> float | None:
+    return float(value) if isinstance(value, (int, float)) else None
+
+
+def _build_history(conversation: Conversation, mirror: ConversationMirror,
+                   messages: list[ConversationMessage]) -> dict:
+    """将镜像还原为与上游 get_msg_history 相同的格式"""
+    mapping = {}
+    for message in messages:
+        mapping[message.message_id] = {
+            "id": message.message_id,
+            "message": None if message.role is None else {
+                "id": message.message_id,
+                "author": {"role": message.role},
+                "create_time": message.create_time,
+                "content": message.content,
+                "metadata": {"model_slug": message.model_slug},
+            },
+            "parent": message.parent_id,
+            "children": [],
+        }
+    for node in mapping.values():
+        # 本地没有的父节点（如上游隐藏的根节点）视为不存在
+        if node["parent"] not in mapping:
+            node["parent"] = None
+        else:
+            mapping[node["parent"]]["children"].append(node["id"])
+    result = {
+        "title": conversation.title,
+        "create_time": mirror.create_time,
+        "update_time": mirror.update_time,
+        "mapping": mapping,
+        "moderation_results": [],
+        "current_node": mirror.current_node,
+    }
+    result["model_name"] = get_conversation_model(result) or ChatModels.unknown.value
+    return result
+
+
+def _is_fresh(mirror: ConversationMirror) -> bool:
+    if not mirror.is_complete:
+        return False
+    max_age = config.get("conversation_mirror_max_age", 0)
+    if max_age <= 0:
+        return True
+    return mirror.synced_time is not None and (datetime.utcnow() - mirror.synced_time).total_seconds() < max_age
+
+
+async def load_conversation_history(conversation: Conversation, allow_stale: bool = False) -> dict | None:
+    """
+    从本地镜像读取对话历史；镜像不完整或已过期时返回 None
+    allow_stale 为 True 时只要有镜像就返回，用于上游不可用时
+    """
+    if not is_mirror_enabled():
+        return None
+    async with get_async_session_context() as session:
+        mirror = await session.execute(
+            select(ConversationMirror).where(ConversationMirror.conversation_id == conversation.conversation_id))
+        mirror = mirror.scalar_one_or_none()
+        if mirror is None or (not allow_stale and not _is_fresh(mirror)):
+            return None
+        messages = await session.execute(
+            select(ConversationMessage).where(ConversationMessage.conversation_id == conversation.conversation_id))
+        messages = messages.scalars().all()
+    return _build_history(conversation, mirror, messages)
+
+
+async def get_current_node(conversation_id: str) -> str | None:
+    """镜像完整时返回对话当前的消息 id，省去提问前向上游查询历史"""
+    if not is_mirror_enabled():
+        return None
+    async with get_async_session_context() as session:
+        mirror = await session.execute(
+            select(ConversationMirror).where(ConversationMirror.conversation_id == conversation_id))
+        mirror = mirror.scalar_one_or_none()
+    if mirror is None or not mirror.is_complete:
+        return None
+    return mirror.current_node
+
+
+async def save_conversation_history(conversation_id: str, history: dict):
+    """用上游返回的历史记录回填镜像；只替换上游返回的节点，保留期间新写入的回复"""
+    if not is_mirror_enabled():
+        return
+    rows = []
+    for message_id, node in (history.get("mapping") or {}).items():
+        message = node.get("message") or {}
+        rows.append({
+            "conversation_id": conversation_id,
+            "message_id": message_id,
+            "parent_id": node.get("parent"),
+            "role": (message.get("author") or {}).get("role"),
+            "model_slug": (message.get("metadata") or {}).get("model_slug"),
+            "content": message.get("content"),
+            "create_time": _get_timestamp(message.get("create_time")),
+        })
+    update_time = _get_timestamp(history.get("update_time"))
+    try:
+        async with get_async_session_context() as session:
+            if rows:
+                await session.execute(delete(ConversationMessage).where(
+                    ConversationMessage.conversation_id == conversation_id,
+                    ConversationMessage.message_id.in_([row["message_id"] for row in rows])))
+                await session.execute(insert(ConversationMessage), rows)
+            mirror = await session.execute(
+                select(ConversationMirror).where(ConversationMirror.conversation_id == conversation_id))
+            mirror = mirror.scalar_one_or_none()
+            if mirror is None:
+                mirror = ConversationMirror(conversation_id=conversation_id)
+            if mirror.update_time is None or update_time is None or mirror.update_time <= update_time:
+                mirror.current_node = history.get("current_node")
+                mirror.update_time = update_time
+            mirror.create_time = _get_timestamp(history.get("create_time"))
+            mirror.is_complete = True
+            mirror.synced_time = datetime.utcnow()
+            session.add(mirror)
+            await session.commit()
+    except Exception as e:
+        logger.warning(f"Save mirror of conversation {conversation_id} failed: {e}")
+
+
+async def append_ask_messages(records: list):
+    """
+    写入提问消息和最终回复，由 AskBookkeeper 批量调用
+    新对话的镜像由此创建并视为完整；已有对话若此前未回填过，仍需在读取时回填
+    """
+    if not is_mirror_enabled():
+        return
+    rows = []
+    new_conversations = {}
+    current_nodes = {}
+    for record in records:
+        reply = record.reply
+        if reply is None or record.conversation_id is None:
+            continue
+        create_time = _get_timestamp(reply.get("create_time")) or time.time()
+        rows.append({
+            "conversation_id": record.conversation_id,
+            "message_id": reply["request_message_id"],
+            "parent_id": reply["request_parent_id"],
+            "role": "user",
+            "model_slug": None,
+            "content": {"content_type": "text", "parts": [record.message]},
+            "create_time": create_time,
+        })
+        rows.append({
+            "conversation_id": record.conversation_id,
+            "message_id": reply["parent_id"],
+            "parent_id": reply["request_message_id"],
+            "role": "assistant",
+            "model_slug": reply.get("model"),
+            "content": {"content_type": "text", "parts": [reply["message"]]},
+            "create_time": create_time,
+        })
+        current_nodes[record.conversation_id] = (reply["parent_id"], create_time)
+        if record.is_new_conv:
+            new_conversations[record.conversation_id] = create_time
+    if not rows:
+        return
+
+    async with get_async_session_context() as session:
+        await session.execute(delete(ConversationMessage).where(
+            ConversationMessage.message_id.in_([row["message_id"] for row in rows])))
+        await session.execute(insert(ConversationMessage), rows)
+        mirrors = await session.execute(
+            select(ConversationMirror).where(ConversationMirror.conversation_id.in_(list(current_nodes.keys()))))
+        mirrors = {mirror.conversation_id: mirror for mirror in mirrors.scalars()}
+        for conversation_id, (current_node, update_time) in current_nodes.items():
+            mirror = mirrors.get(conversation_id)
+            if mirror is None:
+                if conversation_id not in new_conversations:
+                    continue
+                mirror = ConversationMirror(conversation_id=conversation_id, is_complete=True,
+                                            create_time=new_conversations[conversation_id],
+                                            synced_time=datetime.utcnow())
+            mirror.current_node = current_node
+            mirror.update_time = update_time
+            session.add(mirror)
+        await session.commit()
+
+
+async def delete_conversation_history(conversation_id: str):
+    async with get_async_session_context() as session:
+        await session.execute(delete(ConversationMessage).where(ConversationMessage.conversation_id == conversation_id))
+        await session.execute(delete(ConversationMirror).where(ConversationMirror.conversation_id == conversation_id))
+        await session.commit()
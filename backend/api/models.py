@@ -1,7 +1,7 @@
 from typing import List, Optional
 
 from fastapi_users_db_sqlalchemy import Integer, GUID, UUID_ID
-from sqlalchemy import String, DateTime, Enum, Boolean, Float, ForeignKey
+from sqlalchemy import String, DateTime, Enum, Boolean, Float, ForeignKey, JSON, UniqueConstraint, Index
 from sqlalchemy.orm import relationship
 from sqlalchemy.orm import DeclarativeBase
 from sqlalchemy.orm import Mapped, mapped_column
@@ -25,7 +25,7 @@ class User(Base):
     username: Mapped[str] = mapped_column(String(32), unique=True, index=True, comment="用户名")
     nickname: Mapped[str] = mapped_column(String(64), comment="昵称")
     email: Mapped[str]
-    active_time: Mapped[Optional[DateTime]] = mapped_column(DateTime, default=None, comment="最后活跃时间")
+    active_time: Mapped[Optional[DateTime]] = mapped_column(DateTime, default=None, index=True, comment="最后活跃时间")
 
     chat_status: Mapped[ChatStatus] = mapped_column(Enum(ChatStatus), default=ChatStatus.idling, comment="对话状态")
     can_use_paid: Mapped[bool] = mapped_column(Boolean, default=False, comment="是否可以使用paid模型")
@@ -49,6 +49,11 @@ class Conversation(Base):
     """
 
     __tablename__ = "conversation"
+    # 用于按活跃时间分页（GET /conv）
+    __table_args__ = (
+        Index("ix_conversation_user_id_active_time", "user_id", "active_time", "id"),
+        Index("ix_conversation_active_time", "active_time", "id"),
+    )
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     conversation_id: Mapped[str] = mapped_column(String(36), index=True, unique=True)
@@ -60,3 +65,51 @@ class Conversation(Base):
         Enum(ChatModels, values_callable=lambda obj: [e.value for e in obj] if obj else None), default=None, comment="使用的模型")
     create_time: Mapped[Optional[DateTime]] = mapped_column(DateTime, default=None, comment="创建时间")
     active_time: Mapped[Optional[DateTime]] = mapped_column(DateTime, default=None, comment="最后活跃时间")
+    account_name: Mapped[Optional[str]] = mapped_column(String(64), default=None, comment="对话所属的 ChatGPT 账号名")
+
+
+class ConversationMessage(Base):
+    """
+    对话消息的本地镜像，每条记录为消息树上的一个节点
+    """
+
+    __tablename__ = "conversation_message"
+    __table_args__ = (UniqueConstraint("conversation_id", "message_id"),)
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    conversation_id: Mapped[str] = mapped_column(String(36), index=True, comment="对话id")
+    message_id: Mapped[str] = mapped_column(String(36), comment="消息id")
+    parent_id: Mapped[Optional[str]] = mapped_column(String(36), default=None, comment="父消息id")
+    role: Mapped[Optional[str]] = mapped_column(String(32), default=None, comment="发送者角色")
+    model_slug: Mapped[Optional[str]] = mapped_column(String(64), default=None, comment="回复所用模型")
+    content: Mapped[Optional[dict]] = mapped_column(JSON, default=None, comment="消息内容")
+    create_time: Mapped[Optional[float]] = mapped_column(Float, default=None, comment="创建时间戳")
+
+
+class ConversationMirror(Base):
+    """
+    对话镜像的状态；is_complete 表示本地消息树是完整的，可以代替上游返回历史记录
+    """
+
+    __tablename__ = "conversation_mirror"
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    conversation_id: Mapped[str] = mapped_column(String(36), index=True, unique=True)
+    current_node: Mapped[Optional[str]] = mapped_column(String(36), default=None, comment="当前消息id")
+    create_time: Mapped[Optional[float]] = mapped_column(Float, default=None, comment="对话创建时间戳")
+    update_time: Mapped[Optional[float]] = mapped_column(Float, default=None, comment="对话更新时间戳")
+    is_complete: Mapped[bool] = mapped_column(Boolean, default=False, comment="消息树是否完整")
+    synced_time: Mapped[Optional[DateTime]] = mapped_column(DateTime, default=None, comment="最后从上游同步的时间")
+
+
+class ConversationSyncState(Base):
+    """
+    与上游同步对话的进度，每个账号一条
+    """
+
+    __tablename__ = "conversation_sync_state"
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    account_name: Mapped[str] = mapped_column(String(64), unique=True, comment="账号名")
+    offset: Mapped[int] = mapped_column(Integer, default=0, comment="未完成的全量同步已处理到的位置")
+    last_sync_time: Mapped[Optional[DateTime]] = mapped_column(DateTime, default=None, comment="上次完成同步的时间")
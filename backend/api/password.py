@@ -0,0 +1,123 @@
+import asyncio
+import os
+import time
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+from fastapi_users.password import PasswordHelper
+
+from api.config import config
+from api.exceptions import InvalidRequestException
+
+
+class PasswordHasher:
+    """
+    在独立的线程池中计算密码哈希（bcrypt 计算时会释放 GIL），避免阻塞事件循环中的其它请求和回复推送
+    - 线程数为 password_hash_workers，同时最多 password_hash_queue_size 个请求在计算或排队，超出时直接拒绝
+    - 批量导入用户时使用 hash_many，在另一个 password_hash_batch_workers 个线程的线程池中并行计算，不占用登录的线程池
+    """
+
+    def __init__(self):
+        self.password_helper = PasswordHelper()
+        self.max_workers = config.get("password_hash_workers", 2)
+        self.max_pending = config.get("password_hash_queue_size", 32)
+        self.max_batch_workers = config.get("password_hash_batch_workers", None) or os.cpu_count() or 1
+        self.pending = 0
+        self.executor: ThreadPoolExecutor | None = None
+        self.batch_executor: ThreadPoolExecutor | None = None
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="password-hash")
+        return self.executor
+
+    async def _run(self, func, *args):
+        if self.pending >= self.max_pending:
+            raise InvalidRequestException("errors.passwordHashBusy")
+        self.pending += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._get_executor(), func, *args)
+        finally:
+            self.pending -= 1
+
+    async def hash(self, password: str) -> str:
+        return await self._run(self.password_helper.hash, password)
+
+    async def verify_and_update(self, plain_password: str, hashed_password: str) -> tuple[bool, str | None]:
+        return await self._run(self.password_helper.verify_and_update, plain_password, hashed_password)
+
+    async def hash_many(self, passwords: list[str]) -> list[str]:
+        if not passwords:
+            return []
+        if self.batch_executor is None:
+            # bcrypt 计算时释放 GIL，线程即可占满多核；不使用进程池，避免子进程重新导入 main.py
+            self.batch_executor = ThreadPoolExecutor(max_workers=self.max_batch_workers,
+                                                     thread_name_prefix="password-hash-batch")
+        loop = asyncio.get_running_loop()
+        return list(await asyncio.gather(*[
+            loop.run_in_executor(self.batch_executor, self.password_helper.hash, password) for password in passwords]))
+
+    def is_hash(self, value: str) -> bool:
+        """是否为可识别的密码哈希，用于导入已有的哈希"""
+        return self.password_helper.context.identify(value) is not None
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+        if self.batch_executor is not None:
+            self.batch_executor.shutdown(wait=False, cancel_futures=True)
+            self.batch_executor = None
+
+
+class LoginThrottle:
+    """
+    登录失败限流，被拒绝的登录不再计算密码哈希：
+    - 同一用户名在同一 IP 上 login_throttle_window 秒内失败 login_throttle_max_failures 次后，暂停该组合的登录，
+      其它 IP 上的登录不受影响，避免他人通过故意输错密码锁定账号
+    - 同一 IP 在窗口内对任意用户名失败 login_throttle_max_failures_per_ip 次后，暂停该 IP 的登录
+    """
+
+    def __init__(self):
+        self.max_failures = config.get("login_throttle_max_failures", 10)
+        self.max_failures_per_ip = config.get("login_throttle_max_failures_per_ip", 50)
+        self.window = config.get("login_throttle_window", 300)
+        # (username, ip) 或 ip -> 失败时间
+        self.failures: dict[tuple[str, str | None] | str, deque[float]] = defaultdict(deque)
+
+    def _prune(self, key, now: float) -> deque[float]:
+        failures = self.failures[key]
+        while failures and failures[0] <= now - self.window:
+            failures.popleft()
+        if not failures:
+            del self.failures[key]
+        return failures
+
+    def _count(self, key, now: float) -> int:
+        if key not in self.failures:
+            return 0
+        return len(self._prune(key, now))
+
+    def check(self, username: str, ip: str | None = None):
+        now = time.monotonic()
+        if self.max_failures > 0 and self._count((username, ip), now) >= self.max_failures:
+            raise InvalidRequestException("errors.tooManyLoginAttempts")
+        if ip is not None and self.max_failures_per_ip > 0 and self._count(ip, now) >= self.max_failures_per_ip:
+            raise InvalidRequestException("errors.tooManyLoginAttempts")
+
+    def record_failure(self, username: str, ip: str | None = None):
+        now = time.monotonic()
+        if len(self.failures) >= 10000:
+            # 清理过期的记录，避免大量不同用户名占用内存
+            for key in list(self.failures.keys()):
+                self._prune(key, now)
+        if self.max_failures > 0:
+            self._count((username, ip), now)
+            self.failures[(username, ip)].append(now)
+        if ip is not None and self.max_failures_per_ip > 0:
+            self._count(ip, now)
+            self.failures[ip].append(now)
+
+    def reset(self, username: str, ip: str | None = None):
+        """登录成功后清除该用户名在该 IP 上的失败记录；IP 的计数不清除，避免用自己的账号登录来重置"""
+        self.failures.pop((username, ip), None)
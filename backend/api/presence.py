@@ -0,0 +1,133 @@
+import asyncio
+import time
+
+from sqlalchemy import update, bindparam
+
+from api.config import config
+from api.database import get_async_session_context
+from api.enums import ChatStatus
+from api.models import User
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+
+class PresenceLease:
+    """
+    用户的一次提问占用的状态租约；持有者需要在 lease_seconds 内调用 update 或 heartbeat 续约，
+    过期的租约视为已释放，避免异常退出后用户一直处于 queueing / asking
+    """
+
+    def __init__(self, registry: "PresenceRegistry", user_id: int):
+        self.registry = registry
+        self.user_id = user_id
+        self.status = ChatStatus.queueing
+        self.expire_time = 0.0
+        self.heartbeat()
+
+    def is_expired(self) -> bool:
+        return time.monotonic() >= self.expire_time
+
+    def heartbeat(self):
+        self.expire_time = time.monotonic() + self.registry.lease_seconds
+
+    def update(self, status: ChatStatus):
+        if status != self.status:
+            self.status = status
+            self.registry.dirty.add(self.user_id)
+        self.heartbeat()
+
+    def release(self):
+        self.registry.release(self)
+
+
+class PresenceRegistry:
+    """
+    用户当前的对话状态（queueing / asking / idling）只保存在内存中，提问过程中不再写数据库
+    - 每个用户同时只能持有一个有效租约，即只能有一个客户端在提问
+    - 数据库中的 chat_status 仅作快照：配置 presence_snapshot_interval 后定期写入变化的状态
+    """
+
+    def __init__(self):
+        self.lease_seconds = config.get("presence_lease_seconds", 120)
+        self.snapshot_interval = config.get("presence_snapshot_interval", 0)
+        self.leases: dict[int, PresenceLease] = {}
+        # 状态有变化、尚未写入快照的用户
+        self.dirty: set[int] = set()
+        self.worker: asyncio.Task | None = None
+
+    def start(self):
+        if self.snapshot_interval > 0:
+            self.worker = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.worker is None:
+            return
+        self.worker.cancel()
+        try:
+            await self.worker
+        except asyncio.CancelledError:
+            pass
+        self.worker = None
+        # 进程退出后不再有进行中的提问
+        self.dirty.update(self.leases.keys())
+        self.leases.clear()
+        await self.snapshot()
+
+    def acquire(self, user_id: int) -> PresenceLease | None:
+        """用户已有未过期的租约时返回 None"""
+        lease = self.leases.get(user_id)
+        if lease is not None and not lease.is_expired():
+            return None
+        lease = PresenceLease(self, user_id)
+        self.leases[user_id] = lease
+        self.dirty.add(user_id)
+        return lease
+
+    def release(self, lease: PresenceLease):
+        if self.leases.get(lease.user_id) is lease:
+            del self.leases[lease.user_id]
+            self.dirty.add(lease.user_id)
+
+    def get_status(self, user_id: int) -> ChatStatus:
+        lease = self.leases.get(user_id)
+        if lease is None or lease.is_expired():
+            return ChatStatus.idling
+        return lease.status
+
+    def get_user_ids(self, status: ChatStatus) -> list[int]:
+        """处于 status 状态的用户，status 不应为 idling"""
+        return [user_id for user_id, lease in self.leases.items()
+                if lease.status == status and not lease.is_expired()]
+
+    def count(self, status: ChatStatus) -> int:
+        return sum(1 for lease in self.leases.values() if lease.status == status and not lease.is_expired())
+
+    def _purge_expired(self):
+        for user_id, lease in list(self.leases.items()):
+            if lease.is_expired():
+                logger.warning(f"presence lease of user {user_id} expired, released")
+                del self.leases[user_id]
+                self.dirty.add(user_id)
+
+    async def snapshot(self):
+        """将状态有变化的用户写入数据库 chat_status 列"""
+        self._purge_expired()
+        if not self.dirty:
+            return
+        values = [{"b_user_id": user_id, "b_chat_status": self.get_status(user_id)} for user_id in self.dirty]
+        self.dirty.clear()
+        async with get_async_session_context() as session:
+            await session.execute(
+                update(User.__table__).where(User.__table__.c.id == bindparam("b_user_id"))
+                .values(chat_status=bindparam("b_chat_status")),
+                values)
+            await session.commit()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.snapshot_interval)
+            try:
+                await self.snapshot()
+            except Exception as e:
+                logger.warning(f"Snapshot presence failed: {e}")
@@ -0,0 +1,82 @@
+import time
+from collections import defaultdict, deque
+
+from sqlalchemy import update, select, case, or_
+
+from api.config import config
+from api.database import get_async_session_context
+from api.enums import ChatModels
+from api.models import User
+
+
+class AskRateLimiter:
+    """
+    每个用户在最近 60 秒内最多提问 ask_rate_limit_per_minute 次（滑动窗口），为 0 时不限制
+    """
+
+    def __init__(self):
+        self.limit = config.get("ask_rate_limit_per_minute", 0)
+        self.window = 60
+        self.asks: dict[int, deque[float]] = defaultdict(deque)
+
+    def allow(self, user_id: int) -> bool:
+        """允许时记录本次提问"""
+        if self.limit <= 0:
+            return True
+        now = time.monotonic()
+        asks = self.asks[user_id]
+        while asks and asks[0] <= now - self.window:
+            asks.popleft()
+        if len(asks) >= self.limit:
+            return False
+        asks.append(now)
+        return True
+
+
+class QuotaLedger:
+    """
+    提问次数在进入队列前以条件 UPDATE 原子地预扣，次数不足时不会进入队列；提问失败时退还
+    -1 表示不限次数
+    """
+
+    def __init__(self, user_cache):
+        self.user_cache = user_cache
+
+    @staticmethod
+    def _columns(model_name: ChatModels) -> list:
+        user_table = User.__table__
+        columns = [user_table.c.available_ask_count]
+        if model_name == ChatModels.gpt4:
+            columns.append(user_table.c.available_gpt4_ask_count)
+        return columns
+
+    async def reserve(self, user_id: int, model_name: ChatModels) -> str | None:
+        """扣除一次提问次数；次数不足时不扣除，并返回原因"""
+        user_table = User.__table__
+        columns = self._columns(model_name)
+        async with get_async_session_context() as session:
+            result = await session.execute(
+                update(user_table)
+                .where(user_table.c.id == user_id, *[or_(column == -1, column > 0) for column in columns])
+                .values({column: case((column == -1, -1), else_=column - 1) for column in columns}))
+            await session.commit()
+            if result.rowcount == 1:
+                self.user_cache.invalidate(user_id)
+                return None
+            counts = (await session.execute(select(*columns).where(user_table.c.id == user_id))).one_or_none()
+        if counts is None:
+            # 用户已被删除
+            return "errors.userNotExist"
+        if counts[0] != -1 and counts[0] <= 0:
+            return "errors.noAvailableAskCount"
+        return "errors.noAvailableGPT4AskCount"
+
+    async def refund(self, user_id: int, model_name: ChatModels):
+        """退还 reserve 扣除的次数"""
+        user_table = User.__table__
+        async with get_async_session_context() as session:
+            for column in self._columns(model_name):
+                await session.execute(
+                    update(user_table).where(user_table.c.id == user_id, column != -1).values({column: column + 1}))
+            await session.commit()
+        self.user_cache.invalidate(user_id)
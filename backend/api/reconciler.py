@@ -0,0 +1,185 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import dateutil.parser
+from sqlalchemy import select, update, insert, bindparam, or_
+
+from api.config import config
+from api.database import get_async_session_context
+from api.models import Conversation, ConversationSyncState
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+
+def parse_upstream_time(value: str | None) -> datetime | None:
+    """上游返回带时区的 ISO 时间，数据库中保存不带时区的 UTC 时间"""
+    if not value:
+        return None
+    result = dateutil.parser.isoparse(value)
+    if result.tzinfo is not None:
+        result = result.astimezone(timezone.utc).replace(tzinfo=None)
+    return result
+
+
+class ConversationReconciler:
+    """
+    在后台与上游同步对话列表，不阻塞服务启动：
+    - 分页获取上游对话，每页与数据库比对后批量更新标题、创建时间并插入新对话
+    - 每页处理后记录进度，中断后下次从该位置继续
+    - 全量同步完整结束后，将上游已不存在的对话标记为无效
+    - 配置 sync_conversations_interval 后定期增量同步：遇到一整页都在上次同步之前更新过的对话即停止
+    """
+
+    def __init__(self, chatgpt_manager):
+        self.chatgpt_manager = chatgpt_manager
+        self.page_size = config.get("sync_conversations_page_size", 50)
+        self.interval = config.get("sync_conversations_interval", 0)
+        self.worker: asyncio.Task | None = None
+
+    def start(self):
+        if not config.get("sync_conversations_on_startup", True) and self.interval <= 0:
+            return
+        self.worker = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.worker is not None:
+            self.worker.cancel()
+            try:
+                await self.worker
+            except asyncio.CancelledError:
+                pass
+            self.worker = None
+
+    async def _run(self):
+        full = config.get("sync_conversations_on_startup", True)
+        if not full:
+            await asyncio.sleep(self.interval)
+        while True:
+            try:
+                await self.reconcile(full)
+            except Exception as e:
+                logger.warning(f"Sync conversations failed: {e}")
+            if self.interval <= 0:
+                return
+            full = False
+            await asyncio.sleep(self.interval)
+
+    async def reconcile(self, full: bool = True):
+        start_time = datetime.utcnow()
+        seen_ids = set()
+        complete = True
+        for account in self.chatgpt_manager.accounts:
+            try:
+                complete &= await self._reconcile_account(account, full, seen_ids, start_time)
+            except Exception as e:
+                logger.warning(f"Sync conversations of account {account.name} failed: {e}")
+                complete = False
+        if full and complete:
+            await self._invalidate_missing(seen_ids, start_time)
+        logger.info(f"Synced {len(seen_ids)} conversations ({'full' if full else 'incremental'}) "
+                    f"in {(datetime.utcnow() - start_time).total_seconds():.1f}s")
+
+    async def _get_state(self, account_name: str) -> ConversationSyncState:
+        async with get_async_session_context() as session:
+            state = await session.execute(
+                select(ConversationSyncState).where(ConversationSyncState.account_name == account_name))
+            state = state.scalar_one_or_none()
+            if state is None:
+                state = ConversationSyncState(account_name=account_name, offset=0)
+                session.add(state)
+                await session.commit()
+            return state
+
+    async def _save_state(self, account_name: str, **values):
+        async with get_async_session_context() as session:
+            await session.execute(update(ConversationSyncState)
+                                  .where(ConversationSyncState.account_name == account_name).values(**values))
+            await session.commit()
+
+    async def _reconcile_account(self, account, full: bool, seen_ids: set, start_time: datetime) -> bool:
+        """返回是否从头完整地遍历了该账号的对话"""
+        state = await self._get_state(account.name)
+        offset = state.offset if full else 0
+        since = None if full or state.last_sync_time is None else state.last_sync_time
+        if offset:
+            logger.info(f"Resume syncing conversations of account {account.name} from offset {offset}")
+        resumed = offset > 0
+        while True:
+            page = await self.chatgpt_manager.get_conversations_page(account, offset, self.page_size)
+            if not page:
+                break
+            await self._apply_page(page, account, start_time)
+            seen_ids.update(conv["id"] for conv in page)
+            offset += len(page)
+            if full:
+                await self._save_state(account.name, offset=offset)
+            if len(page) < self.page_size:
+                break
+            if since is not None and all((parse_upstream_time(conv.get("update_time")) or since) < since
+                                         for conv in page):
+                break
+        await self._save_state(account.name, offset=0, last_sync_time=start_time)
+        return not resumed
+
+    async def _apply_page(self, page: list[dict], account, start_time: datetime):
+        conversations = {conv["id"]: conv for conv in page}
+        async with get_async_session_context() as session:
+            r = await session.execute(
+                select(Conversation.conversation_id, Conversation.title, Conversation.create_time,
+                       Conversation.account_name)
+                .where(Conversation.conversation_id.in_(list(conversations.keys()))))
+            existing = {row.conversation_id: row for row in r}
+
+            changes = []
+            new_conversations = []
+            for conversation_id, conv in conversations.items():
+                create_time = parse_upstream_time(conv.get("create_time"))
+                row = existing.get(conversation_id)
+                if row is None:
+                    # 刚创建的对话可能还在等待写入数据库（见 AskBookkeeper），留给下次同步
+                    if create_time is not None and create_time > start_time - timedelta(minutes=1):
+                        continue
+                    new_conversations.append({"conversation_id": conversation_id, "title": conv["title"],
+                                              "is_valid": True, "create_time": create_time,
+                                              "account_name": account.name})
+                    logger.debug(f"Found new conversation {conv['title']}({conversation_id})")
+                elif row.title != conv["title"] or row.create_time != create_time or row.account_name != account.name:
+                    changes.append({"b_conversation_id": conversation_id, "b_title": conv["title"],
+                                    "b_create_time": create_time, "b_account_name": account.name})
+
+            if changes:
+                await session.execute(
+                    update(Conversation.__table__)
+                    .where(Conversation.__table__.c.conversation_id == bindparam("b_conversation_id"))
+                    .values(title=bindparam("b_title"), create_time=bindparam("b_create_time"),
+                            account_name=bindparam("b_account_name")),
+                    changes)
+            if new_conversations:
+                await session.execute(insert(Conversation), new_conversations)
+            await session.commit()
+
+    async def _invalidate_missing(self, seen_ids: set, start_time: datetime):
+        """将上游不存在的有效对话标记为无效；同步期间创建或活跃的对话不受影响"""
+        last_id = 0
+        invalidated = 0
+        while True:
+            async with get_async_session_context() as session:
+                r = await session.execute(
+                    select(Conversation.id, Conversation.conversation_id)
+                    .where(Conversation.is_valid, Conversation.id > last_id,
+                           or_(Conversation.create_time.is_(None), Conversation.create_time < start_time),
+                           or_(Conversation.active_time.is_(None), Conversation.active_time < start_time))
+                    .order_by(Conversation.id).limit(1000))
+                rows = r.all()
+                if not rows:
+                    break
+                last_id = rows[-1].id
+                missing = [row.id for row in rows if row.conversation_id not in seen_ids]
+                if missing:
+                    await session.execute(update(Conversation).where(Conversation.id.in_(missing))
+                                          .values(is_valid=False))
+                    await session.commit()
+                    invalidated += len(missing)
+        if invalidated:
+            logger.info(f"Marked {invalidated} conversations missing upstream as invalid")
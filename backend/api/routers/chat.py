@@ -1,29 +1,46 @@
+import asyncio
+import json
 import time
 from datetime import datetime
-from typing import List
+from typing import List, Callable, Awaitable, Literal
 
 import httpx
-import requests
-from fastapi import APIRouter, Depends, WebSocket
+from fastapi import APIRouter, Depends, WebSocket, Body, Query
 from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse
 from httpx import HTTPStatusError
 from sqlalchemy import select, or_, and_, delete, func
 import api.globals as g
 from api.config import config
+from api.bookkeeper import AskRecord
 from api.database import get_async_session_context
 from api.enums import ChatStatus, ChatModels
-from api.exceptions import InvalidParamsException, AuthorityDenyException
+from api.export import export_conversations, ExportSource
+from api.exceptions import InvalidParamsException, AuthorityDenyException, UpstreamUnavailableException, \
+    SelfDefinedException, ResourceNotFoundException
+from api.mirror import load_conversation_history, save_conversation_history, delete_conversation_history, \
+    get_current_node, is_mirror_enabled
 from api.models import User, Conversation
-from api.schema import ConversationSchema
+from api.schema import ConversationSchema, ConversationPageSchema, ConversationSearchSchema
+from api.search import is_search_enabled, search_conversations
+from api.streaming import create_reply_encoder, ReplyStream, forward_reply_stream
 from api.users import current_active_user, websocket_auth, current_super_user
 from revChatGPT.V1 import Error as ChatGPTError
 from api.response import response
+from utils.common import get_active_branch, get_descendants, filter_conversation_mapping, encode_cursor, \
+    decode_cursor
 from utils.logger import get_logger
 
 logger = get_logger(__name__)
 
 router = APIRouter()
 
+# 客户端断开后仍在进行的 SSE 提问；事件循环只持有任务的弱引用，需要在此保持引用直至完成
+background_ask_tasks: set[asyncio.Task] = set()
+
+# 向客户端发送一条消息，WebSocket 为 websocket.send_json，SSE 为写入事件流
+AskSender = Callable[[dict], Awaitable[None]]
+
 
 async def get_conversation_by_id(conversation_id: str, user: User = Depends(current_active_user)):
     async with get_async_session_context() as session:
@@ -36,31 +53,156 @@ async def get_conversation_by_id(conversation_id: str, user: User = Depends(curr
         return conversation
 
 
-@router.get("/conv", tags=["conversation"], response_model=List[ConversationSchema])
-async def get_all_conversations(user: User = Depends(current_active_user), fetch_all: bool = False):
+def get_conversation_keyset_filter(order_column, cursor: list, desc: bool):
+    """
+    按 (order_column, id) 排序、空值排在最后时，位于游标之后的条件
+    """
+    value, last_id = cursor
+    after_id = Conversation.id < last_id if desc else Conversation.id > last_id
+    if order_column is Conversation.id:
+        return after_id
+    if value is None:
+        return and_(order_column.is_(None), after_id)
+    value = datetime.fromisoformat(value)
+    after_value = order_column < value if desc else order_column > value
+    return or_(after_value, and_(order_column == value, after_id), order_column.is_(None))
+
+
+@router.get("/conv", tags=["conversation"],
+            response_model=List[ConversationSchema] | ConversationPageSchema)
+async def get_all_conversations(user: User = Depends(current_active_user), fetch_all: bool = False,
+                                user_id: int = None, model_name: ChatModels = None, is_valid: bool = None,
+                                start_time: datetime = None, end_time: datetime = None, title_prefix: str = None,
+                                order_by: Literal["active_time", "create_time", "id"] = "active_time",
+                                desc: bool = True, limit: int = Query(None, ge=1, le=1000), cursor: str = None,
+                                with_total: bool = False):
     """
     返回自己的有效会话
     对于管理员，返回所有对话，并可以指定是否只返回有效会话
+    筛选：user_id（仅管理员）、model_name、is_valid（仅管理员）、active_time 位于 [start_time, end_time)、title_prefix
+    排序：按 order_by 和 id 排序，order_by 为空的对话排在最后
+    指定 limit 时分页返回 { items, next_cursor, total }，下一页传入上一页的 next_cursor；
+    with_total 为 true 时 total 为符合条件的总数
     """
-    if fetch_all and not user.is_superuser:
+    if (fetch_all or user_id is not None or is_valid is not None) and not user.is_superuser:
         raise AuthorityDenyException()
 
-    stat = and_(Conversation.user_id == user.id, Conversation.is_valid)
-    if fetch_all:
-        stat = None
+    filters = []
+    if not fetch_all:
+        filters += [Conversation.user_id == user.id, Conversation.is_valid]
+    if user_id is not None:
+        filters.append(Conversation.user_id == user_id)
+    if is_valid is not None:
+        filters.append(Conversation.is_valid == is_valid)
+    if model_name is not None:
+        filters.append(Conversation.model_name == model_name)
+    if start_time is not None:
+        filters.append(Conversation.active_time >= start_time)
+    if end_time is not None:
+        filters.append(Conversation.active_time < end_time)
+    if title_prefix:
+        escaped = title_prefix.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        filters.append(Conversation.title.like(f"{escaped}%", escape="\\"))
+
+    order_column = getattr(Conversation, order_by)
+    if order_by == "id":
+        order = [Conversation.id.desc() if desc else Conversation.id.asc()]
+    else:
+        order = [(order_column.desc() if desc else order_column.asc()).nulls_last(),
+                 Conversation.id.desc() if desc else Conversation.id.asc()]
+
+    # 只查询返回的字段，不构造 ORM 对象
+    columns = [getattr(Conversation, field) for field in ConversationSchema.__fields__]
     async with get_async_session_context() as session:
-        if stat is not None:
-            r = await session.execute(select(Conversation).where(stat))
-        else:
-            r = await session.execute(select(Conversation))
-        results = r.scalars().all()
-        results = jsonable_encoder(results)
-        return results
+        if limit is None:
+            r = await session.execute(select(*columns).where(*filters).order_by(*order))
+            return [dict(row) for row in r.mappings()]
+
+        total = None
+        if with_total:
+            total = (await session.execute(select(func.count(Conversation.id)).where(*filters))).scalar()
+        page_filters = list(filters)
+        if cursor is not None:
+            cursor_values = decode_cursor(cursor)
+            if cursor_values is None or len(cursor_values) != 2:
+                raise InvalidParamsException("errors.invalidCursor")
+            try:
+                page_filters.append(get_conversation_keyset_filter(order_column, cursor_values, desc))
+            except (ValueError, TypeError):
+                raise InvalidParamsException("errors.invalidCursor")
+        r = await session.execute(select(*columns).where(*page_filters).order_by(*order).limit(limit + 1))
+        items = [dict(row) for row in r.mappings()]
+
+    next_cursor = None
+    if len(items) > limit:
+        items = items[:limit]
+        last = items[-1]
+        next_cursor = encode_cursor([None if order_by == "id" else last[order_by], last["id"]])
+    return ConversationPageSchema(items=items, next_cursor=next_cursor, total=total)
+
+
+@router.get("/conv/search", tags=["conversation"], response_model=ConversationSearchSchema)
+async def search_in_conversations(q: str, user: User = Depends(current_active_user), fetch_all: bool = False,
+                                  limit: int = Query(20, ge=1, le=100), offset: int = Query(0, ge=0, le=1000)):
+    """
+    按相关度搜索自己的有效对话的标题和消息内容（仅包含已镜像到本地的消息）
+    管理员可以指定 fetch_all 搜索所有对话
+    snippet 为转义后的 HTML，命中的部分以 <mark></mark> 标记
+    """
+    if fetch_all and not user.is_superuser:
+        raise AuthorityDenyException()
+    if not is_search_enabled():
+        raise InvalidParamsException("errors.searchNotSupported")
+    items = await search_conversations(q, None if fetch_all else user.id, limit + 1, offset)
+    next_offset = None
+    if len(items) > limit:
+        items = items[:limit]
+        next_offset = offset + limit
+    return ConversationSearchSchema(items=items, next_offset=next_offset)
+
+
+@router.get("/conv/export", tags=["conversation"])
+async def export_all_conversations(_user: User = Depends(current_super_user), source: ExportSource = "auto",
+                                   user_id: int = None, is_valid: bool = None,
+                                   start_time: datetime = None, end_time: datetime = None,
+                                   cursor: int = None, limit: int = Query(None, ge=1),
+                                   concurrency: int = Query(None, ge=1, le=16)):
+    """
+    以 NDJSON 流式导出对话及其历史记录，每行为 { cursor, conversation, history, error }，按对话 id 排序
+    中断后以最后收到的一行的 cursor 重新请求即可继续
+    """
+
+    async def lines():
+        async for item in export_conversations(g.chatgpt_manager, source, user_id=user_id, is_valid=is_valid,
+                                               start_time=start_time, end_time=end_time, cursor=cursor,
+                                               limit=limit, concurrency=concurrency):
+            yield json.dumps(item, ensure_ascii=False) + "\n"
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
 
 
 @router.get("/conv/{conversation_id}", tags=["conversation"])
-async def get_conversation_history(conversation: Conversation = Depends(get_conversation_by_id)):
-    result = await g.chatgpt_manager.get_conversation_messages(conversation.conversation_id)
+async def get_conversation_history(active_branch_only: bool = False, since: str = None,
+                                   conversation: Conversation = Depends(get_conversation_by_id)):
+    """
+    返回对话历史，格式与上游相同
+    active_branch_only: 只返回从根节点到 current_node 的消息，按顺序排列
+    since: 只返回该消息之后的消息；与 active_branch_only 同时使用时为当前分支上该消息之后的部分
+    """
+    # 优先使用本地镜像，不完整或过期时从上游获取并回填；上游不可用时退回到已有的镜像
+    # 回填镜像的内容必须来自上游，不能是对话历史缓存中可能更旧的副本
+    result = await load_conversation_history(conversation)
+    if result is None:
+        try:
+            result = await g.chatgpt_manager.get_conversation_messages(
+                conversation.conversation_id, use_cache=not is_mirror_enabled(),
+                account_name=conversation.account_name)
+        except Exception:
+            result = await load_conversation_history(conversation, allow_stale=True)
+            if result is None:
+                raise
+        else:
+            await save_conversation_history(conversation.conversation_id, result)
     # 当不知道模型名时，顺便从对话中获取
     if conversation.model_name is None:
         model_name = result.get("model_name")
@@ -70,7 +212,17 @@ async def get_conversation_history(conversation: Conversation = Depends(get_conv
                 conversation.model_name = model_name
                 session.add(conversation)
                 await session.commit()
-    return result
+    if not active_branch_only and since is None:
+        return result
+    if since is not None and since not in result["mapping"]:
+        raise InvalidParamsException("errors.messageNotFound")
+    if active_branch_only:
+        message_ids = get_active_branch(result)
+        if since is not None:
+            message_ids = message_ids[message_ids.index(since) + 1:] if since in message_ids else []
+    else:
+        message_ids = get_descendants(result, since)
+    return filter_conversation_mapping(result, message_ids)
 
 
 @router.delete("/conv/{conversation_id}", tags=["conversation"])
@@ -96,6 +248,7 @@ async def vanish_conversation(conversation: Conversation = Depends(get_conversat
     async with get_async_session_context() as session:
         await session.execute(delete(Conversation).where(Conversation.conversation_id == conversation.conversation_id))
         await session.commit()
+    await delete_conversation_history(conversation.conversation_id)
     return response(200)
 
 
@@ -130,213 +283,306 @@ async def assign_conversation(username: str, conversation_id: str, _user: User =
     return response(200)
 
 
-async def change_user_chat_status(user_id: int, status: ChatStatus):
-    async with get_async_session_context() as session:
-        user = await session.get(User, user_id)
-        user.chat_status = status
-        session.add(user)
-        await session.commit()
-        await session.refresh(user)
-    return user
-
-
 @router.patch("/conv/{conversation_id}/gen_title", tags=["conversation"], response_model=ConversationSchema)
 async def generate_conversation_title(message_id: str, conversation: Conversation = Depends(get_conversation_by_id)):
     if conversation.title is not None:
         raise InvalidParamsException("errors.conversationTitleAlreadyGenerated")
-    async with get_async_session_context() as session:
-        result = await g.chatgpt_manager.generate_conversation_title(conversation.id, message_id)
-        if result["title"]:
-            conversation.title = result["title"]
-            session.add(conversation)
-            await session.commit()
-            await session.refresh(conversation)
-        else:
-            raise InvalidParamsException(f"{result['message']}")
+    # 由后台任务生成并批量写入数据库，这里不占用数据库连接
+    conversation.title = await g.title_generator.generate(conversation.conversation_id, message_id)
     result = jsonable_encoder(conversation)
     return result
 
 
-@router.websocket("/conv")
-async def ask(websocket: WebSocket):
-    """
-    利用 WebSocket 实时更新 ChatGPT 回复.
+async def send_generated_title(send: AskSender, conversation_id: str, title_future: asyncio.Future):
+    """在 title_push_timeout 秒内等待自动生成的标题，并以 title 消息推送给客户端"""
+    try:
+        title = await asyncio.wait_for(asyncio.shield(title_future), config.get("title_push_timeout", 5))
+    except Exception as e:
+        logger.debug(f"title of conversation {conversation_id} not pushed: {e}")
+        return
+    await send({
+        "type": "title",
+        "title": title,
+        "conversation_id": conversation_id
+    })
 
-    客户端第一次连接：发送 { message, conversation_id?, parent_id?, use_paid?, timeout? }
-        conversation_id 为空则新建会话，否则回复 parent_id 指定的消息
-    服务端返回格式：{ type, tip, message, conversation_id, parent_id, use_paid, title }
-    其中：type 可以为 "waiting" / "message" / "title"
-    """
 
-    await websocket.accept()
-    user = await websocket_auth(websocket)
-    logger.debug(f"{user.username} connected to websocket")
+async def resume_reply(send: AskSender, user: User, key: str, stream_mode: str = None) -> tuple[int, str]:
+    """重放进行中（或刚结束）的回复，并继续推送直到回复结束；客户端断开不影响上游"""
+    reply_stream = g.reply_registry.get(key)
+    if reply_stream is None or (reply_stream.user_id != user.id and not user.is_superuser):
+        return 1007, "errors.replyNotFound"
+    encoder = create_reply_encoder(stream_mode, reply_stream.model_name)
+    await forward_reply_stream(reply_stream, encoder, send)
+    return 1000, "tips.finished"
 
-    if user is None:
-        await websocket.close(1008, "errors.unauthorized")
-        return
 
-    if user.chat_status != ChatStatus.idling:
-        await websocket.close(1008, "errors.cannotConnectMoreThanOneClient")
-        return
+async def process_ask(user: User, params: dict, send: AskSender) -> tuple[int, str]:
+    """
+    提问的核心流程，WebSocket 与 SSE 共用：校验参数与额度、排队、转发回复并记录对话
+    消息通过 send 发送，返回 (code, reason)，code 与 WebSocket 关闭码一致
+    """
+
+    if params.get("resume"):
+        return await resume_reply(send, user, params["resume"], params.get("stream_mode", None))
 
-    # 读取用户输入
-    params = await websocket.receive_json()
     message = params.get("message", None)
     conversation_id = params.get("conversation_id", None)
     parent_id = params.get("parent_id", None)
     model_name = params.get("model_name")
     timeout = params.get("timeout", 30)  # default 30s
     new_title = params.get("new_title", None)
+    stream_mode = params.get("stream_mode", None)
 
     if message is None:
-        await websocket.close(1007, "errors.missingMessage")
-        return
+        return 1007, "errors.missingMessage"
     if parent_id is not None and conversation_id is None:
-        await websocket.close(1007, "errors.missingConversationId")
-        return
+        return 1007, "errors.missingConversationId"
 
     is_new_conv = conversation_id is None
     conversation = None
     if not is_new_conv:
         conversation = await get_conversation_by_id(conversation_id, user)
         model_name = model_name or conversation.model_name
+        # 上一次提问的记录可能还未写入镜像，此时读取的 current_node 会使对话产生分叉；
+        # 记录写入失败时不使用镜像，由上游确定 current_node
+        if parent_id is None and await g.ask_bookkeeper.wait_for_conversation(conversation_id):
+            parent_id = await get_current_node(conversation_id)
     else:
         model_name = model_name or ChatModels.default
 
     if isinstance(model_name, str):
         model_name = ChatModels(model_name)
     if model_name == ChatModels.paid and not user.can_use_paid:
-        await websocket.close(1007, "errors.userNotAllowToUsePaidModel")
-        return
+        return 1007, "errors.userNotAllowToUsePaidModel"
     if model_name == ChatModels.gpt4 and not user.can_use_gpt4:
-        await websocket.close(1007, "errors.userNotAllowToUseGPT4Model")
-        return
-    if model_name in [ChatModels.gpt4, ChatModels.paid] and not config.get("chatgpt_paid", False):
-        await websocket.close(1007, "errors.paidModelNotAvailable")
-        return
-
-    # 判断是否能新建对话，以及是否能继续提问
-    async with get_async_session_context() as session:
-        user_conversations_count = await session.execute(
-            select(func.count(Conversation.id)).filter(Conversation.user_id == user.id))
-        user_conversations_count = user_conversations_count.scalar()
-        if is_new_conv and user.max_conv_count != -1 and user_conversations_count >= user.max_conv_count:
-            await websocket.close(1008, "errors.maxConversationCountReached")
-            return
-        if user.available_ask_count != -1 and user.available_ask_count <= 0:
-            await websocket.close(1008, "errors.noAvailableAskCount")
-            return
-        if user.available_gpt4_ask_count != -1 and user.available_gpt4_ask_count <= 0 and model_name == ChatModels.gpt4:
-            await websocket.close(1008, "errors.noAvailableGPT4AskCount")
-            return
-
-    if g.chatgpt_manager.is_busy():
-        await websocket.send_json({
-            "type": "waiting",
-            "tip": "tips.queueing"
-        })
-
-    websocket_code = 1001
-    websocket_reason = "tips.terminated"
+        return 1007, "errors.userNotAllowToUseGPT4Model"
+    if not g.chatgpt_manager.is_model_available(model_name):
+        return 1007, "errors.paidModelNotAvailable"
+    # 已有对话只能在其所属账号上继续
+    if not is_new_conv:
+        try:
+            owner = await g.chatgpt_manager.resolve_account(conversation_id, conversation.account_name)
+        except ResourceNotFoundException:
+            return 1007, "errors.conversationNotFound"
+        if not owner.can_use_model(model_name):
+            return 1007, "errors.paidModelNotAvailable"
+
+    # 判断是否能新建对话
+    if is_new_conv and user.max_conv_count != -1:
+        async with get_async_session_context() as session:
+            user_conversations_count = await session.execute(
+                select(func.count(Conversation.id)).filter(Conversation.user_id == user.id))
+            if user_conversations_count.scalar() >= user.max_conv_count:
+                return 1008, "errors.maxConversationCountReached"
+
+    # 标记用户为 queueing；同一用户同时只能有一个提问
+    lease = g.presence.acquire(user.id)
+    if lease is None:
+        return 1008, "errors.cannotConnectMoreThanOneClient"
+
+    # 此后的任何异常都需要释放租约，已扣除的次数在提问未完成时退还
+    refund = False
+    code = 1001
+    reason = "tips.terminated"
+    sender = None
     try:
-        # 标记用户为 queueing
-        await change_user_chat_status(user.id, ChatStatus.queueing)
-
-        async with g.chatgpt_manager.semaphore:
-            await change_user_chat_status(user.id, ChatStatus.asking)
-            await websocket.send_json({
+        if not user.is_superuser and not g.ask_rate_limiter.allow(user.id):
+            return 1008, "errors.askRateLimited"
+        # 进入队列前原子地扣除次数，次数不足的用户不会占用队列
+        quota_error = await g.quota_ledger.reserve(user.id, model_name)
+        if quota_error is not None:
+            return 1008, quota_error
+        refund = True
+
+        async with g.chatgpt_manager.queue_ask(user, model_name, conversation_id) as ticket:
+            # 排队期间定期推送队列位置和预计等待时间
+            while not ticket.is_ready():
+                position = g.chatgpt_manager.get_queue_position(ticket)
+                await send({
+                    "type": "waiting",
+                    "tip": "tips.queueing",
+                    "position": position,
+                    "eta": g.chatgpt_manager.get_queue_eta(ticket),
+                    "waiting_count": position
+                })
+                await ticket.wait(config.get("ask_queue_status_interval", 3))
+                lease.heartbeat()
+            account = ticket.account
+            lease.update(ChatStatus.asking)
+            await send({
                 "type": "waiting",
                 "tip": "tips.waiting"
             })
             request_start_time = time.time()
-            async for data in g.chatgpt_manager.ask(message, conversation_id, parent_id, timeout, model_name):
-                reply = {
-                    "type": "message",
-                    "message": data["message"],
-                    "conversation_id": data["conversation_id"],
-                    "parent_id": data["parent_id"],
-                    "model_name": model_name.value
-                }
-                await websocket.send_json(reply)
-                if conversation_id is None:
-                    conversation_id = data["conversation_id"]
+            # 上游读取与客户端发送解耦：客户端较慢时只会丢弃中间快照，不会拖慢上游
+            reply_stream = ReplyStream(user.id, model_name)
+            encoder = create_reply_encoder(stream_mode, model_name)
+            sender = asyncio.create_task(forward_reply_stream(reply_stream, encoder, send))
+            try:
+                async for data in g.chatgpt_manager.ask(account, message, conversation_id, parent_id, timeout,
+                                                        model_name):
+                    reply_stream.push(data)
+                    g.reply_registry.track(reply_stream, data)
+                    lease.heartbeat()
+                    if conversation_id is None:
+                        conversation_id = data["conversation_id"]
+            except Exception:
+                sender.cancel()
+                raise
+            finally:
+                reply_stream.finish()
             logger.debug(
-                f"finish ask {conversation_id} ({model_name}), using time: {time.time() - request_start_time}s")
-
-            async with get_async_session_context() as session:
-                # 若新建了对话，则添加到数据库
-                if is_new_conv and conversation_id is not None:
-                    # 设置默认标题
-                    try:
-                        if new_title is not None:
-                            await g.chatgpt_manager.set_conversation_title(conversation_id, new_title)
-                    except Exception as e:
-                        logger.warning(e)
-                    finally:
-                        current_time = datetime.utcnow()
-                        conversation = Conversation(conversation_id=conversation_id, title=new_title, user_id=user.id,
-                                                    model_name=model_name, create_time=current_time,
-                                                    active_time=current_time)
-                        session.add(conversation)
-                # 更新 conversation
-                if not is_new_conv:
-                    conversation = await session.get(Conversation, conversation.id)  # 此前的 conversation 属于另一个session
-                    conversation.active_time = datetime.utcnow()
-                    if conversation.model_name != model_name:
-                        conversation.model_name = model_name
-                    session.add(conversation)
-
-                # 扣除一次对话次数
-                # 这里的逻辑是：available_ask_count 是总的对话次数，available_gpt4_ask_count 是 GPT4 的对话次数
-                # 如果都有限制，则都要扣除一次
-                # 如果 available_ask_count 不限但是 available_gpt4_ask_count 限制，则只扣除 available_gpt4_ask_count
-                if user.available_ask_count != -1 or user.available_gpt4_ask_count != -1:
-                    user = await session.get(User, user.id)
-                    if user.available_ask_count != -1:
-                        assert user.available_ask_count > 0
-                        user.available_ask_count -= 1
-                    if model_name == ChatModels.gpt4 and user.available_gpt4_ask_count != -1:
-                        assert user.available_gpt4_ask_count > 0
-                        user.available_gpt4_ask_count -= 1
-                    session.add(user)
-                await session.commit()
-            websocket_code = 1000
-            websocket_reason = "tips.finished"
-    except requests.exceptions.Timeout:
-        await websocket.send_json({
+                f"finish ask {conversation_id} ({model_name}) on account {account.name}, "
+                f"using time: {time.time() - request_start_time}s")
+
+        # 账号已释放，对话记录交由后台批量写入
+        # 新对话未指定标题时，在写入数据库后自动生成
+        title_message_id = None
+        if is_new_conv and new_title is None and reply_stream.data is not None:
+            title_message_id = reply_stream.data["parent_id"]
+        record = AskRecord(user.id, conversation_id, model_name, is_new_conv, new_title=new_title,
+                           title_message_id=title_message_id, message=message, reply=reply_stream.data,
+                           account_name=account.name)
+        await g.ask_bookkeeper.submit(record)
+        refund = False
+        # 账号已释放，再等待剩余内容发送给客户端；结束前对话须已写入数据库，客户端随后会刷新对话列表
+        await sender
+        try:
+            await record.saved
+        except Exception as e:
+            logger.error(f"Save conversation {conversation_id} of {user.username} failed: {e}")
+        if record.title_future is not None:
+            await send_generated_title(send, conversation_id, record.title_future)
+        code = 1000
+        reason = "tips.finished"
+    except UpstreamUnavailableException as e:
+        await send({
+            "type": "error",
+            "tip": "errors.upstreamUnavailable",
+            "message": e.message
+        })
+        code = 1013
+        reason = "errors.upstreamUnavailable"
+    except httpx.TimeoutException:
+        await send({
             "type": "error",
             "tip": "errors.timeout"
         })
-        websocket_code = 1001
-        websocket_reason = "errors.timout"
+        code = 1001
+        reason = "errors.timout"
     except ChatGPTError as e:
-        await websocket.send_json({
+        await send({
             "type": "error",
             "tip": "errors.chatgptResponseError",
             "message": f"{e.source} {e.code}: {e.message}"
         })
-        websocket_code = 1001
-        websocket_reason = "errors.chatgptResponseError"
+        code = 1001
+        reason = "errors.chatgptResponseError"
     except HTTPStatusError as e:
         logger.error(str(e))
-        await websocket.send_json({
+        await send({
             "type": "error",
             "tip": "errors.httpStatusError",
             "message": str(e)
         })
-        websocket_code = 1014
-        websocket_reason = "errors.httpStatusError"
+        code = 1014
+        reason = "errors.httpStatusError"
     except Exception as e:
         logger.error(str(e))
-        await websocket.send_json({
+        await send({
             "type": "error",
             "tip": "errors.unknownError",
             "message": str(e)
         })
-        websocket_code = 1011
-        websocket_reason = "errors.unknownError"
+        code = 1011
+        reason = "errors.unknownError"
     finally:
-        await change_user_chat_status(user.id, ChatStatus.idling)
-        g.chatgpt_manager.reset_chat()
-        await websocket.close(websocket_code, websocket_reason)
+        if sender is not None and not sender.done():
+            sender.cancel()
+        lease.release()
+        if refund:
+            try:
+                await g.quota_ledger.refund(user.id, model_name)
+            except Exception as e:
+                logger.error(f"Refund ask count of {user.username} failed: {e}")
+    return code, reason
+
+
+@router.websocket("/conv")
+async def ask(websocket: WebSocket):
+    """
+    利用 WebSocket 实时更新 ChatGPT 回复.
+
+    客户端第一次连接：发送 { message, conversation_id?, parent_id?, use_paid?, timeout?, stream_mode? }
+        conversation_id 为空则新建会话，否则回复 parent_id 指定的消息
+        stream_mode 为 "delta" 时使用增量模式，见 api.streaming.DeltaReplyEncoder
+    断线重连：发送 { resume: message_id 或 conversation_id, stream_mode? }，重放已生成的内容并继续接收
+    服务端返回格式：{ type, tip, message, conversation_id, parent_id, use_paid, title }
+    其中：type 可以为 "waiting" / "message" / "title"
+    """
+
+    await websocket.accept()
+    user = await websocket_auth(websocket)
+
+    if user is None:
+        await websocket.close(1008, "errors.unauthorized")
+        return
+    logger.debug(f"{user.username} connected to websocket")
+
+    # 读取用户输入
+    params = await websocket.receive_json()
+    code, reason = await process_ask(user, params, websocket.send_json)
+    await websocket.close(code, reason)
+
+
+@router.post("/conv/ask", tags=["conversation"])
+async def ask_sse(params: dict = Body(...), user: User = Depends(current_active_user)):
+    """
+    以 Server-Sent Events 返回 ChatGPT 回复，参数和消息格式与 WebSocket 接口相同，
+    便于经由 HTTP/2 复用连接；最后一条消息为 { type: "close", code, reason }，code 与 WebSocket 关闭码一致。
+    客户端断开后上游回复仍会继续并记录，可使用 resume 参数重新接收
+    """
+    # 容量为 1：客户端读取较慢时 send 会等待，由 ReplyStream 合并中间快照
+    queue: asyncio.Queue[dict | None] = asyncio.Queue(1)
+    disconnected = False
+
+    async def send(data: dict):
+        if disconnected:
+            raise ConnectionError("client disconnected")
+        await queue.put(data)
+
+    async def run():
+        try:
+            try:
+                code, reason = await process_ask(user, params, send)
+                close = {"type": "close", "code": code, "reason": reason}
+            except SelfDefinedException as e:
+                close = {"type": "close", "code": 1007, "reason": e.reason.strip("[]"), "message": e.message}
+            except ConnectionError:
+                raise
+            except Exception as e:
+                logger.error(f"sse ask of {user.username} failed: {e}")
+                close = {"type": "close", "code": 1011, "reason": "errors.unknownError", "message": str(e)}
+            await send(close)
+            await queue.put(None)
+        except ConnectionError:
+            logger.debug(f"{user.username} disconnected from sse ask")
+
+    async def event_stream():
+        nonlocal disconnected
+        task = asyncio.create_task(run())
+        background_ask_tasks.add(task)
+        task.add_done_callback(background_ask_tasks.discard)
+        try:
+            while (data := await queue.get()) is not None:
+                yield f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+        finally:
+            # 不取消 task，使上游回复和记账在客户端断开后仍能完成
+            disconnected = True
+            while not queue.empty():
+                queue.get_nowait()
+
+    logger.debug(f"{user.username} connected to sse ask")
+    return StreamingResponse(event_stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
@@ -1,59 +1,45 @@
 import os
-from datetime import datetime, timedelta
 
 from fastapi import APIRouter, Depends
-from sqlalchemy import select
 
 import api.globals as g
 from api.config import config
-from api.database import get_async_session_context
-from api.enums import ChatStatus
 from api.models import User
 from api.schema import ServerStatusSchema, LogFilterOptions
 from api.users import current_active_user, current_super_user
 
 router = APIRouter()
 
-server_status_cache = None
-server_status_cache_last_update_time: datetime | None = None
-
 
 @router.get("/status", tags=["status"], response_model=ServerStatusSchema)
 async def get_status(_user: User = Depends(current_active_user)):
-    global server_status_cache
-    global server_status_cache_last_update_time
-    if server_status_cache is not None and server_status_cache_last_update_time is not None:
-        if server_status_cache_last_update_time > datetime.utcnow() - timedelta(seconds=5):
-            return server_status_cache
-    async with get_async_session_context() as session:
-        users = await session.execute(select(User))
-        users = users.scalars().all()
-    # 根据 active_time, 统计 5m/1h/1d 内的在线人数
-    active_user_in_5m = 0
-    active_user_in_1h = 0
-    active_user_in_1d = 0
-    current_time = datetime.utcnow()
-    queueing_count = 0
-    for user in users:
-        if not user.active_time or user.is_superuser:
-            continue
-        if user.chat_status == ChatStatus.queueing:
-            queueing_count += 1
-        if user.active_time > current_time - timedelta(minutes=5):
-            active_user_in_5m += 1
-        if user.active_time > current_time - timedelta(hours=1):
-            active_user_in_1h += 1
-        if user.active_time > current_time - timedelta(days=1):
-            active_user_in_1d += 1
-    server_status_cache = ServerStatusSchema(
-        active_user_in_5m=active_user_in_5m,
-        active_user_in_1h=active_user_in_1h,
-        active_user_in_1d=active_user_in_1d,
+    """在线人数和队列统计均来自内存，不查询数据库"""
+    active_users = g.activity_tracker.count_active_users()
+    queue_stats = g.chatgpt_manager.get_queue_stats()
+    return ServerStatusSchema(
+        active_user_in_5m=active_users["5m"],
+        active_user_in_1h=active_users["1h"],
+        active_user_in_1d=active_users["1d"],
         is_chatbot_busy=g.chatgpt_manager.is_busy(),
-        chatbot_waiting_count=queueing_count
+        chatbot_waiting_count=queue_stats["waiting_count"],
+        chatbot_waiting_count_by_model=queue_stats["waiting_count_by_model"],
+        chatbot_asking_count=queue_stats["asking_count"],
+        chatbot_average_wait_time=queue_stats["average_wait_time"],
+        chatbot_average_ask_duration=queue_stats["average_ask_duration"],
+        chatbot_circuit_state=g.chatgpt_manager.circuit_breaker.state.value
     )
-    server_status_cache_last_update_time = datetime.utcnow()
-    return server_status_cache
+
+
+@router.get("/status/cache", tags=["status"])
+async def get_cache_status(_user: User = Depends(current_super_user)):
+    """对话历史缓存的命中率等统计信息"""
+    return g.chatgpt_manager.conversation_cache.stats()
+
+
+@router.get("/status/circuit_breaker", tags=["status"])
+async def get_circuit_breaker_status(_user: User = Depends(current_super_user)):
+    """上游熔断器的状态和最近调用统计"""
+    return g.chatgpt_manager.circuit_breaker.stats()
 
 
 def read_last_n_lines(file_path, n, exclude_key_words=None):
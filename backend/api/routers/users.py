@@ -1,13 +1,23 @@
+from datetime import datetime
+from typing import List, Literal
+
+from sqlalchemy import and_, or_, func
 from sqlalchemy.future import select
 
+import api.globals as g
 from api.database import get_async_session_context, get_user_db_context
 from api.exceptions import AuthorityDenyException, InvalidParamsException
-from api.models import User
+from api.enums import ChatStatus
+from api.models import User, Conversation
 from api.response import response
-from api.schema import UserRead, UserUpdate, UserCreate, LimitSchema
+from api.schema import UserRead, UserUpdate, UserCreate, LimitSchema, UserImportSchema, UserImportResultSchema, \
+    BatchLimitSchema, UserPageSchema
+from api.user_batch import import_users, update_limits
 from api.users import auth_backend, fastapi_users, current_active_user, get_user_manager_context, current_super_user
 
-from fastapi import APIRouter, Depends
+from utils.common import encode_cursor, decode_cursor
+
+from fastapi import APIRouter, Depends, Query
 
 router = APIRouter()
 
@@ -28,12 +38,138 @@ router.include_router(
 )
 
 
-@router.get("/user", tags=["user"])
-async def get_all_users(_user: User = Depends(current_super_user)):
+def get_user_keyset_filter(order_column, cursor: list, desc: bool):
+    """
+    按 (order_column, id) 排序、空值排在最后时，位于游标之后的条件
+    """
+    value, last_id = cursor
+    after_id = User.id < last_id if desc else User.id > last_id
+    if order_column is User.id:
+        return after_id
+    if value is None:
+        return and_(order_column.is_(None), after_id)
+    if order_column is User.active_time:
+        value = datetime.fromisoformat(value)
+    after_value = order_column < value if desc else order_column > value
+    return or_(after_value, and_(order_column == value, after_id), order_column.is_(None))
+
+
+@router.get("/user", tags=["user"], response_model=List[dict] | UserPageSchema)
+async def get_all_users(_user: User = Depends(current_super_user), fields: List[str] = Query(None),
+                        is_superuser: bool = None, chat_status: ChatStatus = None, username_prefix: str = None,
+                        active_after: datetime = None, active_before: datetime = None,
+                        ask_count_below: int = None, gpt4_ask_count_below: int = None,
+                        order_by: Literal["id", "active_time", "username", "available_ask_count",
+                                          "available_gpt4_ask_count"] = "id",
+                        desc: bool = False, limit: int = Query(None, ge=1, le=1000), cursor: str = None,
+                        with_total: bool = False, with_conversation_count: bool = False):
+    """
+    返回用户列表，不包含密码哈希；fields 指定只返回的字段（id 总会返回）
+    筛选：is_superuser、chat_status（实时状态）、username_prefix、active_time 位于 [active_after, active_before)、
+    ask_count_below / gpt4_ask_count_below（剩余次数少于该值，不含不限次数的用户）
+    排序：按 order_by 和 id 排序，order_by 为空的用户排在最后
+    指定 limit 时分页返回 { items, next_cursor, total }，用法与 GET /conv 相同
+    with_conversation_count 为 true 时，每个用户附带 conversation_count（对话数，含无效对话）
+    """
+    field_names = [field for field in UserRead.__fields__ if fields is None or field in fields or field == "id"]
+    if fields is not None and len(field_names) != len(set(fields) | {"id"}):
+        raise InvalidParamsException("errors.invalidFields")
+    # 排序字段需要用于生成游标
+    columns = [getattr(User, field) for field in dict.fromkeys(field_names + [order_by])]
+
+    filters = []
+    if is_superuser is not None:
+        filters.append(User.is_superuser == is_superuser)
+    if chat_status == ChatStatus.idling:
+        filters.append(User.id.not_in(g.presence.get_user_ids(ChatStatus.queueing)
+                                      + g.presence.get_user_ids(ChatStatus.asking)))
+    elif chat_status is not None:
+        filters.append(User.id.in_(g.presence.get_user_ids(chat_status)))
+    if username_prefix:
+        filters.append(User.username.startswith(username_prefix, autoescape=True))
+    if active_after is not None:
+        filters.append(User.active_time >= active_after)
+    if active_before is not None:
+        filters.append(User.active_time < active_before)
+    for column, below in ((User.available_ask_count, ask_count_below),
+                          (User.available_gpt4_ask_count, gpt4_ask_count_below)):
+        if below is not None:
+            filters += [column != -1, column < below]
+
+    order_column = getattr(User, order_by)
+    if order_by == "id":
+        order = [User.id.desc() if desc else User.id.asc()]
+    else:
+        order = [(order_column.desc() if desc else order_column.asc()).nulls_last(),
+                 User.id.desc() if desc else User.id.asc()]
+
+    total = None
+    async with get_async_session_context() as session:
+        if limit is not None and with_total:
+            total = (await session.execute(select(func.count(User.id)).where(*filters))).scalar()
+        page_filters = list(filters)
+        if limit is not None and cursor is not None:
+            cursor_values = decode_cursor(cursor)
+            if cursor_values is None or len(cursor_values) != 2:
+                raise InvalidParamsException("errors.invalidCursor")
+            try:
+                page_filters.append(get_user_keyset_filter(order_column, cursor_values, desc))
+            except (ValueError, TypeError):
+                raise InvalidParamsException("errors.invalidCursor")
+        statement = select(*columns).where(*page_filters).order_by(*order)
+        if limit is not None:
+            statement = statement.limit(limit + 1)
+        items = [dict(row) for row in (await session.execute(statement)).mappings()]
+
+        next_cursor = None
+        if limit is not None and len(items) > limit:
+            items = items[:limit]
+            last = items[-1]
+            next_cursor = encode_cursor([None if order_by == "id" else last[order_by], last["id"]])
+
+        if with_conversation_count and items:
+            r = await session.execute(
+                select(Conversation.user_id, func.count(Conversation.id))
+                .where(Conversation.user_id.in_([item["id"] for item in items]))
+                .group_by(Conversation.user_id))
+            conversation_counts = dict(r.all())
+            for item in items:
+                item["conversation_count"] = conversation_counts.get(item["id"], 0)
+
+    for item in items:
+        if order_by not in field_names:
+            del item[order_by]
+        # 实时状态和未写入数据库的活跃时间以内存中的为准
+        if "chat_status" in item:
+            item["chat_status"] = g.presence.get_status(item["id"])
+        if "active_time" in item:
+            item["active_time"] = g.activity_tracker.get_active_time(item["id"], item["active_time"])
+    if limit is None:
+        return items
+    return UserPageSchema(items=items, next_cursor=next_cursor, total=total)
+
+
+def get_user_read(user: User) -> UserRead:
+    """实时状态和未写入数据库的活跃时间以内存中的为准，数据库中的 chat_status 默认不会更新"""
+    user_read = UserRead.from_orm(user)
+    user_read.chat_status = g.presence.get_status(user.id)
+    user_read.active_time = g.activity_tracker.get_active_time(user.id, user.active_time)
+    return user_read
+
+
+# 以下两个路由先于 fastapi_users 的用户路由注册，覆盖其中的同名路由
+@router.get("/user/me", tags=["user"], response_model=UserRead)
+async def get_me(user: User = Depends(current_active_user)):
+    return get_user_read(user)
+
+
+@router.get("/user/{user_id}", tags=["user"], response_model=UserRead)
+async def get_user(user_id: int, _user: User = Depends(current_super_user)):
     async with get_async_session_context() as session:
-        r = await session.execute(select(User))
-        results = r.scalars().all()
-        return results
+        target_user = await session.get(User, user_id)
+        if target_user is None:
+            raise InvalidParamsException("errors.userNotExist")
+        return get_user_read(target_user)
 
 
 @router.patch("/user/{user_id}/reset-password", tags=["user"])
@@ -47,9 +183,10 @@ async def reset_password(user_id: int = None, new_password: str = None, _user: U
                 target_user = result
                 if target_user is None:
                     raise InvalidParamsException("errors.userNotExist")
-                target_user.hashed_password = user_manager.password_helper.hash(new_password)
+                target_user.hashed_password = await g.password_hasher.hash(new_password)
                 session.add(target_user)
                 await session.commit()
+                g.user_cache.invalidate(user_id)
                 return response(200)
 
 
@@ -67,9 +204,23 @@ async def update_limit(limit: LimitSchema, user_id: int = None, _user: User = De
         # 使用**kargs类似的写法，但是跳过None值
         session.add(target_user)
         await session.commit()
+        g.user_cache.invalidate(user_id)
         return response(200)
 
 
+@router.post("/user/import", tags=["user"], response_model=UserImportResultSchema)
+async def import_users_in_batch(users: List[UserImportSchema], _user: User = Depends(current_super_user)):
+    """批量创建用户，用户名或邮箱已存在的用户被跳过；也可使用 python -m utils.manage_users import 从 CSV/JSON 导入"""
+    created, skipped = await import_users(users)
+    return UserImportResultSchema(created=created, skipped=skipped)
+
+
+@router.post("/user/limit", tags=["user"])
+async def update_limit_in_batch(params: BatchLimitSchema, _user: User = Depends(current_super_user)):
+    """在一个事务中修改一批用户的限制，返回修改的用户数"""
+    return response(200, result=await update_limits(params))
+
+
 router.include_router(
     fastapi_users.get_users_router(UserRead, UserUpdate),
     prefix="/user",
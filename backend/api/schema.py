@@ -51,6 +51,39 @@ class UserCreate(schemas.BaseUserCreate):
         orm_mode = True
 
 
+class UserPageSchema(BaseModel):
+    items: list[dict]  # UserRead 中 fields 指定的字段，可能附带 conversation_count
+    next_cursor: str | None = None
+    total: int | None = None
+
+
+class UserImportSchema(UserCreate):
+    """批量导入的用户；password 和 hashed_password（已有的 bcrypt 哈希）二选一"""
+    password: str | None = None
+    hashed_password: str | None = None
+    can_use_gpt4: bool = False
+    available_gpt4_ask_count: int = -1
+
+    @validator("hashed_password", always=True)
+    def password_or_hashed_password(cls, v, values):
+        if (v is None) == (values.get("password") is None):
+            raise ValueError("exactly one of password and hashed_password is required")
+        return v
+
+
+class UserImportResultSchema(BaseModel):
+    created: int
+    skipped: list[str]  # 用户名或邮箱已存在的用户名
+
+
+class BatchLimitSchema(BaseModel):
+    """将 limit 应用到所有符合条件的用户；不指定 user_ids 和 username_prefix 时为全部用户"""
+    user_ids: list[int] | None = None
+    username_prefix: str | None = None
+    include_superusers: bool = False
+    limit: LimitSchema
+
+
 class ConversationSchema(BaseModel):
     id: int = -1
     conversation_id: uuid.UUID = None
@@ -65,12 +98,37 @@ class ConversationSchema(BaseModel):
         use_enum_values = True
 
 
+class ConversationPageSchema(BaseModel):
+    items: list[ConversationSchema]
+    next_cursor: str | None = None
+    total: int | None = None
+
+
+class ConversationSearchHitSchema(BaseModel):
+    conversation_id: str
+    title: str | None = None
+    message_id: str | None = None
+    kind: str  # "title" / "message"
+    snippet: str | None = None
+    rank: float
+
+
+class ConversationSearchSchema(BaseModel):
+    items: list[ConversationSearchHitSchema]
+    next_offset: int | None = None
+
+
 class ServerStatusSchema(BaseModel):
     active_user_in_5m: int = None
     active_user_in_1h: int = None
     active_user_in_1d: int = None
     is_chatbot_busy: bool = None
     chatbot_waiting_count: int = None
+    chatbot_waiting_count_by_model: dict[str, int] = None
+    chatbot_asking_count: int = None
+    chatbot_average_wait_time: float = None
+    chatbot_average_ask_duration: float = None
+    chatbot_circuit_state: str = None
 
 
 class LogFilterOptions(BaseModel):
@@ -0,0 +1,193 @@
+import html
+import re
+
+from sqlalchemy import text, inspect
+
+from api.config import config
+from api.database import get_async_session_context, engine
+from api.exceptions import InvalidParamsException
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+# 对话标题和本地镜像中消息内容的全文索引，由数据库触发器在写入时增量维护
+# 索引行的 id：标题为 -conversation.id，消息为 conversation_message.id
+SEARCH_TABLE = "conversation_search"
+# 数据库生成 snippet 时使用私有区字符标记命中部分，转义内容后再替换为 <mark></mark>
+SNIPPET_START = "\ue000"
+SNIPPET_END = "\ue001"
+SNIPPET_MARK_START = "<mark>"
+SNIPPET_MARK_END = "</mark>"
+SNIPPET_TOKENS = 32
+
+SQLITE_DDL = [
+    # 表名和分词器在下方格式化
+    "CREATE VIRTUAL TABLE IF NOT EXISTS {table} USING fts5("
+    "conversation_id UNINDEXED, message_id UNINDEXED, kind UNINDEXED, content, tokenize = '{tokenizer}')",
+    "CREATE TRIGGER IF NOT EXISTS {table}_title_insert AFTER INSERT ON conversation "
+    "WHEN new.title IS NOT NULL BEGIN "
+    "INSERT INTO {table}(rowid, conversation_id, message_id, kind, content) "
+    "VALUES (-new.id, new.conversation_id, NULL, 'title', new.title); END",
+    "CREATE TRIGGER IF NOT EXISTS {table}_title_update AFTER UPDATE OF title ON conversation BEGIN "
+    "DELETE FROM {table} WHERE rowid = -old.id; "
+    "INSERT INTO {table}(rowid, conversation_id, message_id, kind, content) "
+    "SELECT -new.id, new.conversation_id, NULL, 'title', new.title WHERE new.title IS NOT NULL; END",
+    "CREATE TRIGGER IF NOT EXISTS {table}_title_delete AFTER DELETE ON conversation BEGIN "
+    "DELETE FROM {table} WHERE rowid = -old.id; END",
+    "CREATE TRIGGER IF NOT EXISTS {table}_message_insert AFTER INSERT ON conversation_message "
+    "WHEN new.role IN ('user', 'assistant') AND json_valid(new.content) BEGIN "
+    "INSERT INTO {table}(rowid, conversation_id, message_id, kind, content) "
+    "SELECT new.id, new.conversation_id, new.message_id, 'message', group_concat(value, ' ') "
+    "FROM json_each(new.content, '$.parts'); END",
+    "CREATE TRIGGER IF NOT EXISTS {table}_message_delete AFTER DELETE ON conversation_message BEGIN "
+    "DELETE FROM {table} WHERE rowid = old.id; END",
+]
+
+SQLITE_BACKFILL = [
+    "INSERT INTO {table}(rowid, conversation_id, message_id, kind, content) "
+    "SELECT -id, conversation_id, NULL, 'title', title FROM conversation WHERE title IS NOT NULL",
+    "INSERT INTO {table}(rowid, conversation_id, message_id, kind, content) "
+    "SELECT m.id, m.conversation_id, m.message_id, 'message', "
+    "(SELECT group_concat(value, ' ') FROM json_each(m.content, '$.parts')) "
+    "FROM conversation_message m WHERE m.role IN ('user', 'assistant') AND json_valid(m.content)",
+]
+
+POSTGRES_DDL = [
+    "CREATE TABLE IF NOT EXISTS {table} ("
+    "id BIGINT PRIMARY KEY, conversation_id VARCHAR(36) NOT NULL, message_id VARCHAR(36), "
+    "kind VARCHAR(16) NOT NULL, content TEXT, "
+    "tsv tsvector GENERATED ALWAYS AS (to_tsvector('{ts_config}'::regconfig, coalesce(content, ''))) STORED)",
+    "CREATE INDEX IF NOT EXISTS ix_{table}_tsv ON {table} USING GIN (tsv)",
+    "CREATE OR REPLACE FUNCTION {table}_title() RETURNS trigger AS $$ BEGIN "
+    "IF TG_OP IN ('UPDATE', 'DELETE') THEN DELETE FROM {table} WHERE id = -OLD.id; END IF; "
+    "IF TG_OP IN ('INSERT', 'UPDATE') AND NEW.title IS NOT NULL THEN "
+    "INSERT INTO {table}(id, conversation_id, message_id, kind, content) "
+    "VALUES (-NEW.id, NEW.conversation_id, NULL, 'title', NEW.title); END IF; "
+    "RETURN NULL; END $$ LANGUAGE plpgsql",
+    "DROP TRIGGER IF EXISTS {table}_title ON conversation",
+    "CREATE TRIGGER {table}_title AFTER INSERT OR UPDATE OF title OR DELETE ON conversation "
+    "FOR EACH ROW EXECUTE FUNCTION {table}_title()",
+    "CREATE OR REPLACE FUNCTION {table}_message() RETURNS trigger AS $$ BEGIN "
+    "IF TG_OP = 'DELETE' THEN DELETE FROM {table} WHERE id = OLD.id; "
+    "ELSIF NEW.role IN ('user', 'assistant') AND json_typeof(NEW.content -> 'parts') = 'array' THEN "
+    "INSERT INTO {table}(id, conversation_id, message_id, kind, content) "
+    "SELECT NEW.id, NEW.conversation_id, NEW.message_id, 'message', string_agg(value, ' ') "
+    "FROM json_array_elements_text(NEW.content -> 'parts'); END IF; "
+    "RETURN NULL; END $$ LANGUAGE plpgsql",
+    "DROP TRIGGER IF EXISTS {table}_message ON conversation_message",
+    "CREATE TRIGGER {table}_message AFTER INSERT OR DELETE ON conversation_message "
+    "FOR EACH ROW EXECUTE FUNCTION {table}_message()",
+]
+
+POSTGRES_BACKFILL = [
+    "INSERT INTO {table}(id, conversation_id, message_id, kind, content) "
+    "SELECT -id, conversation_id, NULL, 'title', title FROM conversation WHERE title IS NOT NULL "
+    "ON CONFLICT DO NOTHING",
+    "INSERT INTO {table}(id, conversation_id, message_id, kind, content) "
+    "SELECT m.id, m.conversation_id, m.message_id, 'message', "
+    "(SELECT string_agg(value, ' ') FROM json_array_elements_text(m.content -> 'parts')) "
+    "FROM conversation_message m "
+    "WHERE m.role IN ('user', 'assistant') AND json_typeof(m.content -> 'parts') = 'array' "
+    "ON CONFLICT DO NOTHING",
+]
+
+
+def is_search_enabled() -> bool:
+    return config.get("enable_search", True)
+
+
+def _get_sqlite_tokenizer() -> str:
+    # trigram 支持中文等不以空格分词的语言，但查询至少需要 3 个字符
+    return config.get("search_sqlite_tokenizer", "trigram")
+
+
+def _get_postgres_ts_config() -> str:
+    ts_config = config.get("search_postgres_ts_config", "simple")
+    if not re.fullmatch(r"\w+", ts_config):
+        raise ValueError(f"Invalid search_postgres_ts_config: {ts_config}")
+    return ts_config
+
+
+def _create_search_index(conn):
+    dialect = conn.dialect.name
+    if dialect == "sqlite":
+        ddl, backfill = SQLITE_DDL, SQLITE_BACKFILL
+    elif dialect == "postgresql":
+        ddl, backfill = POSTGRES_DDL, POSTGRES_BACKFILL
+    else:
+        logger.warning(f"Full-text search is not supported on {dialect}, skipped")
+        return
+    exists = inspect(conn).has_table(SEARCH_TABLE)
+    params = {"table": SEARCH_TABLE}
+    if dialect == "sqlite":
+        params["tokenizer"] = _get_sqlite_tokenizer()
+    else:
+        params["ts_config"] = _get_postgres_ts_config()
+    for statement in ddl:
+        conn.exec_driver_sql(statement.format(**params))
+    if not exists:
+        logger.info("building full-text search index...")
+        for statement in backfill:
+            conn.exec_driver_sql(statement.format(**params))
+        logger.info("full-text search index built")
+
+
+async def create_search_index():
+    """创建全文索引及维护它的触发器；首次创建时回填已有的标题和消息"""
+    if not is_search_enabled():
+        return
+    async with engine.begin() as conn:
+        await conn.run_sync(_create_search_index)
+
+
+def _render_snippet(snippet: str | None) -> str | None:
+    """转义 snippet 中的 HTML，再把命中标记替换为 <mark></mark>"""
+    if snippet is None:
+        return None
+    return html.escape(snippet).replace(SNIPPET_START, SNIPPET_MARK_START).replace(SNIPPET_END, SNIPPET_MARK_END)
+
+
+async def search_conversations(query: str, user_id: int | None, limit: int, offset: int) -> list[dict]:
+    """
+    按相关度返回命中的标题和消息；user_id 为 None 时搜索所有用户的有效和无效对话
+    snippet 为转义后的 HTML，命中部分以 <mark></mark> 标记
+    """
+    query = query.strip()
+    if not query:
+        raise InvalidParamsException("errors.searchQueryEmpty")
+    params = {"query": query, "limit": limit, "offset": offset}
+    user_filter = ""
+    if user_id is not None:
+        user_filter = "AND c.user_id = :user_id AND c.is_valid"
+        params["user_id"] = user_id
+
+    async with get_async_session_context() as session:
+        dialect = session.bind.dialect.name
+        if dialect == "sqlite":
+            if _get_sqlite_tokenizer() == "trigram" and len(query) < 3:
+                raise InvalidParamsException("errors.searchQueryTooShort")
+            # 作为短语匹配，避免用户输入被解析为 FTS5 查询语法
+            params.update(query='"' + query.replace('"', '""') + '"',
+                          start=SNIPPET_START, end=SNIPPET_END, tokens=SNIPPET_TOKENS)
+            statement = (
+                f"SELECT s.conversation_id, s.message_id, s.kind, c.title, "
+                f"snippet({SEARCH_TABLE}, 3, :start, :end, '…', :tokens) AS snippet, "
+                f"-bm25({SEARCH_TABLE}) AS rank "
+                f"FROM {SEARCH_TABLE} s JOIN conversation c ON c.conversation_id = s.conversation_id "
+                f"WHERE {SEARCH_TABLE} MATCH :query {user_filter} "
+                f"ORDER BY bm25({SEARCH_TABLE}) LIMIT :limit OFFSET :offset")
+        elif dialect == "postgresql":
+            ts_config = _get_postgres_ts_config()
+            statement = (
+                f"SELECT s.conversation_id, s.message_id, s.kind, c.title, "
+                f"ts_headline('{ts_config}'::regconfig, s.content, q, "
+                f"'StartSel={SNIPPET_START}, StopSel={SNIPPET_END}, MaxWords={SNIPPET_TOKENS}, MinWords=8') "
+                f"AS snippet, ts_rank(s.tsv, q) AS rank "
+                f"FROM {SEARCH_TABLE} s JOIN conversation c ON c.conversation_id = s.conversation_id, "
+                f"websearch_to_tsquery('{ts_config}'::regconfig, :query) q "
+                f"WHERE s.tsv @@ q {user_filter} "
+                f"ORDER BY rank DESC LIMIT :limit OFFSET :offset")
+        else:
+            raise InvalidParamsException("errors.searchNotSupported")
+        r = await session.execute(text(statement), params)
+        return [dict(row, snippet=_render_snippet(row["snippet"])) for row in r.mappings()]
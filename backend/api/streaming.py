@@ -0,0 +1,194 @@
+import asyncio
+import time
+from typing import Awaitable, Callable
+
+from api.config import config
+from api.enums import ChatModels
+
+
+class FullReplyEncoder:
+    """
+    默认模式：每一帧都包含完整的回复内容和 id
+    """
+
+    def __init__(self, model_name: ChatModels):
+        self.model_name = model_name
+        self.last_data = None
+
+    def encode(self, data: dict) -> dict | None:
+        self.last_data = data
+        return {
+            "type": "message",
+            "message": data["message"],
+            "conversation_id": data["conversation_id"],
+            "parent_id": data["parent_id"],
+            "model_name": self.model_name.value
+        }
+
+    def finish(self) -> dict | None:
+        return None
+
+
+class DeltaReplyEncoder(FullReplyEncoder):
+    """
+    增量模式：
+    - 第一帧包含 conversation_id / parent_id / model_name 和 delta
+    - 之后的帧只包含 delta，即相对上一帧追加的文本；id 变化时会再次带上 id
+    - 若新内容不是已发送内容的延续，则发送带 message 字段的完整内容，客户端应直接替换
+    - 最后一帧带有 done: true 以及完整的 message，用于客户端校验
+    """
+
+    def __init__(self, model_name: ChatModels):
+        super().__init__(model_name)
+        self.sent_message = ""
+        self.sent_ids = None
+
+    def encode(self, data: dict) -> dict | None:
+        self.last_data = data
+        message = data["message"] or ""
+        reply = {"type": "message"}
+        ids = (data["conversation_id"], data["parent_id"])
+        if ids != self.sent_ids:
+            reply.update(conversation_id=data["conversation_id"], parent_id=data["parent_id"],
+                         model_name=self.model_name.value)
+            self.sent_ids = ids
+        if message.startswith(self.sent_message):
+            delta = message[len(self.sent_message):]
+            if not delta and len(reply) == 1:
+                return None
+            reply["delta"] = delta
+        else:
+            reply["message"] = message
+        self.sent_message = message
+        return reply
+
+    def finish(self) -> dict | None:
+        if self.last_data is None:
+            return None
+        return {
+            "type": "message",
+            "done": True,
+            "message": self.last_data["message"],
+            "conversation_id": self.last_data["conversation_id"],
+            "parent_id": self.last_data["parent_id"],
+            "model_name": self.model_name.value
+        }
+
+
+def create_reply_encoder(stream_mode: str | None, model_name: ChatModels) -> FullReplyEncoder:
+    if stream_mode == "delta":
+        return DeltaReplyEncoder(model_name)
+    return FullReplyEncoder(model_name)
+
+
+class ReplyStream:
+    """
+    上游回复与客户端发送之间的缓冲区
+    上游只写入最新的快照（push），不会因客户端慢而阻塞；
+    消费者按时间窗口或积累的字符数合并读取，落后时中间的快照会被直接丢弃
+    """
+
+    def __init__(self, user_id: int = None, model_name: ChatModels = None):
+        self.user_id = user_id
+        self.model_name = model_name
+        self.data: dict | None = None
+        self.version = 0
+        self.done = False
+        self.finish_time: float | None = None
+        self.subscribers: set[asyncio.Event] = set()
+
+    def _notify(self):
+        for event in self.subscribers:
+            event.set()
+
+    def push(self, data: dict):
+        self.data = data
+        self.version += 1
+        self._notify()
+
+    def finish(self):
+        self.done = True
+        self.finish_time = time.time()
+        self._notify()
+
+    def _pending_size(self, sent_size: int) -> int:
+        message = self.data["message"] if self.data else None
+        return len(message or "") - sent_size
+
+    async def subscribe(self, interval: float = None, max_size: int = None):
+        """
+        依次返回合并后的快照：有新内容时最多等待 interval 秒，
+        若期间新增内容超过 max_size 个字符或上游已结束则立即返回
+        """
+        interval = config.get("stream_coalesce_interval", 0.05) if interval is None else interval
+        max_size = config.get("stream_coalesce_size", 1024) if max_size is None else max_size
+        loop = asyncio.get_running_loop()
+        event = asyncio.Event()
+        self.subscribers.add(event)
+        sent_version = 0
+        sent_size = 0
+        try:
+            while True:
+                event.clear()
+                if self.version == sent_version:
+                    if self.done:
+                        break
+                    await event.wait()
+                    continue
+                deadline = loop.time() + interval
+                while not self.done and self._pending_size(sent_size) < max_size:
+                    remaining = deadline - loop.time()
+                    if remaining <= 0:
+                        break
+                    event.clear()
+                    try:
+                        await asyncio.wait_for(event.wait(), remaining)
+                    except asyncio.TimeoutError:
+                        break
+                sent_version = self.version
+                sent_size = self._pending_size(0)
+                yield self.data
+        finally:
+            self.subscribers.discard(event)
+
+
+class ReplyRegistry:
+    """
+    记录进行中的回复，使断线重连的客户端可以通过 message_id 或 conversation_id 继续接收；
+    由于上游每次返回的都是完整内容，只需保留最新快照即可重放。
+    回复结束后仍保留 grace_period 秒
+    """
+
+    def __init__(self, grace_period: float = None):
+        self.grace_period = config.get("reply_resume_grace_period", 60) if grace_period is None else grace_period
+        # message_id / conversation_id -> ReplyStream
+        self.replies: dict[str, ReplyStream] = {}
+
+    def _cleanup(self):
+        expire_time = time.time() - self.grace_period
+        for key, stream in list(self.replies.items()):
+            if stream.done and stream.finish_time < expire_time:
+                del self.replies[key]
+
+    def track(self, stream: ReplyStream, data: dict):
+        """上游返回数据后调用，以回复的 message_id 和 conversation_id 登记该回复"""
+        for key in (data.get("parent_id"), data.get("conversation_id")):
+            if key and self.replies.get(key) is not stream:
+                self._cleanup()
+                self.replies[key] = stream
+
+    def get(self, key: str) -> ReplyStream | None:
+        self._cleanup()
+        return self.replies.get(key)
+
+
+async def forward_reply_stream(stream: ReplyStream, encoder: FullReplyEncoder,
+                               send: Callable[[dict], Awaitable[None]]):
+    """将合并后的快照编码为消息帧并发送，直到上游结束"""
+    async for data in stream.subscribe():
+        reply = encoder.encode(data)
+        if reply is not None:
+            await send(reply)
+    reply = encoder.finish()
+    if reply is not None:
+        await send(reply)
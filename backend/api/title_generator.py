@@ -0,0 +1,121 @@
+import asyncio
+
+from sqlalchemy import update, bindparam
+
+from api.config import config
+from api.database import get_async_session_context
+from api.exceptions import InvalidParamsException
+from api.models import Conversation
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+
+class TitleJob:
+    def __init__(self, conversation_id: str, message_id: str):
+        self.conversation_id = conversation_id
+        self.message_id = message_id
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+        # 提交者可能已不再等待结果，避免未读取的异常被记录为错误
+        self.future.add_done_callback(lambda f: f.cancelled() or f.exception())
+
+
+class TitleGenerator:
+    """
+    后台生成对话标题：
+    - 任务队列有上限，队列满时丢弃新任务
+    - 以低于所有用户的优先级进入提问队列，不与用户提问争抢账号
+    - 生成的标题批量写入数据库
+    """
+
+    def __init__(self, chatgpt_manager):
+        self.chatgpt_manager = chatgpt_manager
+        self.priority = config.get("title_generation_priority", 100)
+        self.max_queue_size = config.get("title_generation_queue_size", 100)
+        self.batch_size = config.get("title_generation_batch_size", 20)
+        self.flush_interval = config.get("title_generation_flush_interval", 5)
+        self.queue: asyncio.Queue[TitleJob] | None = None
+        self.worker: asyncio.Task | None = None
+        # (conversation_id, title)
+        self.pending_titles: list[tuple[str, str]] = []
+
+    def start(self):
+        self.queue = asyncio.Queue(self.max_queue_size)
+        self.worker = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.worker is not None:
+            self.worker.cancel()
+            try:
+                await self.worker
+            except asyncio.CancelledError:
+                pass
+            self.worker = None
+        await self._flush()
+
+    def submit(self, conversation_id: str, message_id: str) -> asyncio.Future | None:
+        """提交任务并返回结果的 future；队列已满或未启动时返回 None"""
+        if self.queue is None:
+            return None
+        job = TitleJob(conversation_id, message_id)
+        try:
+            self.queue.put_nowait(job)
+        except asyncio.QueueFull:
+            logger.warning(f"Title generation queue is full, skip conversation {conversation_id}")
+            return None
+        return job.future
+
+    async def generate(self, conversation_id: str, message_id: str) -> str:
+        future = self.submit(conversation_id, message_id)
+        if future is None:
+            raise InvalidParamsException("errors.titleGenerationBusy")
+        return await future
+
+    async def _run(self):
+        while True:
+            try:
+                job = await asyncio.wait_for(self.queue.get(), self.flush_interval)
+            except asyncio.TimeoutError:
+                await self._flush()
+                continue
+            await self._process(job)
+            if len(self.pending_titles) >= self.batch_size or self.queue.empty():
+                await self._flush()
+
+    async def _process(self, job: TitleJob):
+        try:
+            async with self.chatgpt_manager.queue_ask(conversation_id=job.conversation_id,
+                                                      priority=self.priority) as ticket:
+                await ticket.wait()
+                result = await self.chatgpt_manager.generate_conversation_title(job.conversation_id,
+                                                                                job.message_id, ticket)
+        except Exception as e:
+            logger.warning(f"Generate title for conversation {job.conversation_id} failed: {e}")
+            if not job.future.done():
+                job.future.set_exception(e)
+            return
+        title = result.get("title")
+        if not title:
+            if not job.future.done():
+                job.future.set_exception(InvalidParamsException(f"{result.get('message')}"))
+            return
+        self.pending_titles.append((job.conversation_id, title))
+        if not job.future.done():
+            job.future.set_result(title)
+
+    async def _flush(self):
+        if not self.pending_titles:
+            return
+        titles, self.pending_titles = self.pending_titles, []
+        try:
+            async with get_async_session_context() as session:
+                table = Conversation.__table__
+                await session.execute(
+                    update(table).where(table.c.conversation_id == bindparam("b_conversation_id"))
+                    .values(title=bindparam("b_title")),
+                    [{"b_conversation_id": conversation_id, "b_title": title} for conversation_id, title in titles]
+                )
+                await session.commit()
+            logger.debug(f"Saved {len(titles)} generated titles")
+        except Exception as e:
+            logger.error(f"Save generated titles failed: {e}")
@@ -0,0 +1,78 @@
+from sqlalchemy import select, update, insert, or_
+
+import api.globals as g
+from api.database import get_async_session_context
+from api.enums import ChatStatus
+from api.exceptions import InvalidParamsException
+from api.models import User
+from api.schema import UserImportSchema, BatchLimitSchema
+
+# 每条 IN 查询的参数个数
+CHUNK_SIZE = 500
+
+
+async def import_users(users: list[UserImportSchema]) -> tuple[int, list[str]]:
+    """
+    批量创建用户：一次查询已存在的用户名和邮箱，多进程计算密码哈希，在一个事务中插入
+    用户名或邮箱已存在的用户被跳过；返回 (创建数, 跳过的用户名)
+    """
+    usernames = [user.username for user in users]
+    emails = [user.email for user in users]
+    if len(set(usernames)) != len(usernames) or len(set(emails)) != len(emails):
+        raise InvalidParamsException("errors.duplicateUsersInImport")
+    for user in users:
+        if user.hashed_password is not None and not g.password_hasher.is_hash(user.hashed_password):
+            raise InvalidParamsException("errors.invalidPasswordHash")
+
+    existing_usernames = set()
+    existing_emails = set()
+    async with get_async_session_context() as session:
+        for i in range(0, len(users), CHUNK_SIZE):
+            r = await session.execute(select(User.username, User.email).where(
+                or_(User.username.in_(usernames[i:i + CHUNK_SIZE]), User.email.in_(emails[i:i + CHUNK_SIZE]))))
+            for username, email in r:
+                existing_usernames.add(username)
+                existing_emails.add(email)
+    skipped = [user.username for user in users
+               if user.username in existing_usernames or user.email in existing_emails]
+    users = [user for user in users
+             if user.username not in existing_usernames and user.email not in existing_emails]
+    if not users:
+        return 0, skipped
+
+    to_hash = [user for user in users if user.hashed_password is None]
+    hashed_passwords = dict(zip((user.username for user in to_hash),
+                                await g.password_hasher.hash_many([user.password for user in to_hash])))
+    rows = []
+    for user in users:
+        row = user.dict(exclude={"password", "hashed_password"})
+        row["hashed_password"] = user.hashed_password or hashed_passwords[user.username]
+        row["chat_status"] = ChatStatus.idling
+        rows.append(row)
+    async with get_async_session_context() as session:
+        await session.execute(insert(User), rows)
+        await session.commit()
+    return len(rows), skipped
+
+
+async def update_limits(params: BatchLimitSchema) -> int:
+    """在一个事务中修改符合条件的用户的限制，返回修改的用户数"""
+    values = {attr: value for attr, value in params.limit.dict(exclude_unset=True).items() if value is not None}
+    if not values:
+        raise InvalidParamsException("errors.emptyLimit")
+    filters = []
+    if params.user_ids is not None:
+        filters.append(User.id.in_(params.user_ids))
+    if params.username_prefix:
+        filters.append(User.username.startswith(params.username_prefix, autoescape=True))
+    if not params.include_superusers:
+        filters.append(User.is_superuser.is_(False))
+
+    async with get_async_session_context() as session:
+        user_ids = (await session.execute(select(User.id).where(*filters))).scalars().all()
+        for i in range(0, len(user_ids), CHUNK_SIZE):
+            await session.execute(update(User).where(User.id.in_(user_ids[i:i + CHUNK_SIZE])).values(**values))
+        await session.commit()
+    for user_id in user_ids:
+        g.user_cache.invalidate(user_id)
+    return len(user_ids)
@@ -3,14 +3,18 @@ from datetime import datetime
 from typing import Any
 
 from fastapi.security import OAuth2PasswordRequestForm
+import jwt
 from starlette.websockets import WebSocket
 
 import api.exceptions
+import api.globals as g
 from api.config import config
 from typing import Optional
 
 from fastapi import Depends, Request
 from fastapi_users import BaseUserManager, FastAPIUsers, models, IntegerIDMixin, InvalidID, schemas
+from fastapi_users.exceptions import UserNotExists, UserAlreadyExists
+from fastapi_users.jwt import decode_jwt
 from fastapi_users.authentication import CookieTransport, AuthenticationBackend
 from fastapi_users.authentication import JWTStrategy
 
@@ -36,8 +40,34 @@ cookie_transport = CookieTransport(
 
 # auth backend
 
+class CachedJWTStrategy(JWTStrategy):
+    """
+    验证通过的 token 及对应用户缓存在 g.user_cache 中，命中时不解码 JWT、不查询数据库
+    """
+
+    async def read_token(self, token: Optional[str], user_manager: BaseUserManager[User, Integer]) -> Optional[User]:
+        if token is None:
+            return None
+        user = await g.user_cache.get(token)
+        if user is not None:
+            return user
+        try:
+            data = decode_jwt(token, self.decode_key, self.token_audience, algorithms=[self.algorithm])
+            user_id = user_manager.parse_id(data["sub"])
+        except (jwt.PyJWTError, KeyError, InvalidID):
+            return None
+        version = g.user_cache.get_version(user_id)
+        try:
+            user = await user_manager.get(user_id)
+        except UserNotExists:
+            return None
+        await g.user_cache.set(token, user, version, data.get("exp"))
+        return user
+
+
 def get_jwt_strategy() -> JWTStrategy:
-    return JWTStrategy(secret=config.get("jwt_secret"), lifetime_seconds=config.get("jwt_lifetime_seconds", 86400))
+    return CachedJWTStrategy(secret=config.get("jwt_secret"),
+                             lifetime_seconds=config.get("jwt_lifetime_seconds", 86400))
 
 
 auth_backend = AuthenticationBackend(
@@ -58,6 +88,9 @@ async def get_by_username(username: str) -> Optional[UP]:
 
 
 class UserManager(IntegerIDMixin, BaseUserManager[User, Integer]):
+    # 发起请求的客户端 IP，用于登录限流；不经过 HTTP 请求时为空
+    client_host: str | None = None
+
     async def create(self, user_create: schemas.UC, safe: bool = False, request: Optional[Request] = None) -> models.UP:
         # 检查用户名、手机、邮箱是否已经存在
         async with get_async_session_context() as session:
@@ -65,7 +98,24 @@ class UserManager(IntegerIDMixin, BaseUserManager[User, Integer]):
                 raise api.exceptions.InvalidRequestException("用户名已存在")
             if (await session.execute(select(User).filter(User.email == user_create.email))).scalar_one_or_none():
                 raise api.exceptions.InvalidRequestException("邮箱已存在")
-        return await super().create(user_create, safe, request)
+        # 与 BaseUserManager.create 相同，但在 g.password_hasher 的线程池中计算哈希
+        await self.validate_password(user_create.password, user_create)
+        if await self.user_db.get_by_email(user_create.email) is not None:
+            raise UserAlreadyExists()
+        user_dict = user_create.create_update_dict() if safe else user_create.create_update_dict_superuser()
+        user_dict["hashed_password"] = await g.password_hasher.hash(user_dict.pop("password"))
+        created_user = await self.user_db.create(user_dict)
+        await self.on_after_register(created_user, request)
+        return created_user
+
+    async def _update(self, user: User, update_dict: dict[str, Any]) -> User:
+        # 修改和重置密码时，在线程池中计算哈希
+        if "password" in update_dict:
+            update_dict = dict(update_dict)
+            password = update_dict.pop("password")
+            await self.validate_password(password, user)
+            update_dict["hashed_password"] = await g.password_hasher.hash(password)
+        return await super()._update(user, update_dict)
 
     reset_password_token_secret = SECRET
     verification_token_secret = SECRET
@@ -86,25 +136,40 @@ class UserManager(IntegerIDMixin, BaseUserManager[User, Integer]):
 
         :param credentials: The user credentials.
         """
+        # 短时间内失败次数过多的用户名（按来源 IP 区分）或 IP 直接拒绝，不再计算哈希
+        client_host = self.client_host
+        g.login_throttle.check(credentials.username, client_host)
         user = await get_by_username(credentials.username)
 
         if user is None:
             # Run the hasher to mitigate timing attack
             # Inspired from Django: https://code.djangoproject.com/ticket/20760
-            self.password_helper.hash(credentials.password)
+            await g.password_hasher.hash(credentials.password)
+            g.login_throttle.record_failure(credentials.username, client_host)
             return None
 
-        verified, updated_password_hash = self.password_helper.verify_and_update(
+        verified, updated_password_hash = await g.password_hasher.verify_and_update(
             credentials.password, user.hashed_password
         )
         if not verified:
+            g.login_throttle.record_failure(credentials.username, client_host)
             return None
+        g.login_throttle.reset(credentials.username, client_host)
         # Update password hash to a more robust one if needed
         if updated_password_hash is not None:
             await self.user_db.update(user, {"hashed_password": updated_password_hash})
 
         return user
 
+    async def on_after_update(self, user: User, update_dict: dict[str, Any], request: Optional[Request] = None):
+        g.user_cache.invalidate(user.id)
+
+    async def on_after_reset_password(self, user: User, request: Optional[Request] = None):
+        g.user_cache.invalidate(user.id)
+
+    async def on_after_delete(self, user: User, request: Optional[Request] = None):
+        g.user_cache.invalidate(user.id)
+
     async def on_after_register(self, user: User, request: Optional[Request] = None):
         print(f"User {user.id} has registered.")
 
@@ -124,6 +189,10 @@ async def websocket_auth(websocket: WebSocket) -> User | None:
     user = None
     try:
         cookie = websocket._cookies[config.get("cookie_name", "user_auth")]
+        cached_user = await g.user_cache.get(cookie)
+        if cached_user is not None:
+            user = cached_user if cached_user.is_active else None
+            return user
         async with get_async_session_context() as session:
             async with get_user_db_context(session) as user_db:
                 async with get_user_manager_context(user_db) as user_manager:
@@ -138,8 +207,12 @@ async def websocket_auth(websocket: WebSocket) -> User | None:
         return user
 
 
-async def get_user_manager(user_db=Depends(get_user_db)):
-    yield UserManager(user_db)
+async def get_user_manager(user_db=Depends(get_user_db), request: Request = None):
+    user_manager = UserManager(user_db)
+    if request is not None and request.client is not None:
+        # 经过反向代理时由 uvicorn 的 proxy_headers 还原为真实 IP
+        user_manager.client_host = request.client.host
+    yield user_manager
 
 
 get_user_manager_context = contextlib.asynccontextmanager(get_user_manager)
@@ -151,18 +224,10 @@ __current_active_user = fastapi_users.current_user(active=True)
 
 
 async def current_active_user(user: User = Depends(__current_active_user)):
-    current_time = datetime.utcnow()
-    user.active_time = current_time
-    try:
-        async with get_async_session_context() as session:
-            user_update = await session.get(User, user.id)
-            user_update.active_time = current_time
-            session.add(user_update)
-            await session.commit()
-    except Exception as e:
-        logger.warning(e)
-    finally:
-        return user
+    # 活跃时间由 g.activity_tracker 定期批量写入数据库
+    user.active_time = datetime.utcnow()
+    g.activity_tracker.touch(user.id, user.active_time, user.is_superuser)
+    return user
 
 
 current_super_user = fastapi_users.current_user(active=True, superuser=True)
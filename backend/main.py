@@ -3,7 +3,7 @@ import uvicorn
 
 from fastapi import FastAPI
 from fastapi.exceptions import RequestValidationError
-from sqlalchemy import select
+from sqlalchemy import update
 from starlette.exceptions import HTTPException as StarletteHTTPException
 
 from api.config import config
@@ -14,9 +14,10 @@ if config.get("chatgpt_base_url"):
 
 import api.globals as g
 from api.enums import ChatStatus
-from api.models import Conversation, User
+from api.models import User
 from api.response import CustomJSONResponse, PrettyJSONResponse, handle_exception_response
 from api.database import create_db_and_tables, get_async_session_context
+from api.search import create_search_index
 from api.exceptions import SelfDefinedException
 from api.routers import users, chat, status
 from fastapi.middleware.cors import CORSMiddleware
@@ -25,7 +26,6 @@ from utils.logger import setup_logger, get_log_config, get_logger
 from utils.proxy import close_reverse_proxy
 from utils.create_user import create_user
 
-import dateutil.parser
 from revChatGPT.V1 import Error as ChatGPTError
 
 setup_logger()
@@ -80,6 +80,13 @@ async def validation_exception_handler(request, exc):
 async def on_startup():
     await create_db_and_tables()
     logger.info("database initialized")
+    await create_search_index()
+
+    g.title_generator.start()
+    g.ask_bookkeeper.start()
+    g.presence.start()
+    await g.activity_tracker.load()
+    g.activity_tracker.start()
 
     if config.get("create_initial_admin_user", False):
         await create_user(config.get("initial_admin_username"),
@@ -95,79 +102,43 @@ async def on_startup():
                           config.get("initial_user_password"),
                           is_superuser=False)
 
-    if not config.get("sync_conversations_on_startup", True):
-        return
-
-    # 重置所有用户chat_status
+    # 重置所有用户chat_status，实时状态见 g.presence
     async with get_async_session_context() as session:
-        r = await session.execute(select(User))
-        results = r.scalars().all()
-        for user in results:
-            user.chat_status = ChatStatus.idling
-            session.add(user)
+        await session.execute(update(User).values(chat_status=ChatStatus.idling))
         await session.commit()
 
     # 运行 Proxy Server
     if config.get("run_reverse_proxy", False):
         from utils.proxy import run_reverse_proxy
         run_reverse_proxy()
-        await asyncio.sleep(2)  # 等待 Proxy Server 启动
 
-    # 获取 ChatGPT 对话，并同步数据库
-    try:
-        logger.debug(f"Using {os.environ.get('CHATGPT_BASE_URL', '<default_bypass>')} as ChatGPT base url")
-        result = await g.chatgpt_manager.get_conversations()
-        if result and len(result) > 0:
-            logger.info(f"Fetched {len(result)} conversations")
-            conversations_map = {conv['id']: conv for conv in result}
-            async with get_async_session_context() as session:
-                r = await session.execute(select(Conversation))
-                results = r.scalars().all()
-
-                for conv_db in results:
-                    conv = conversations_map.get(conv_db.conversation_id, None)
-                    if conv:
-                        # 同步标题
-                        if conv["title"] != conv_db.title:
-                            conv_db.title = conv["title"]
-                            logger.info(f"Conversation {conv_db.conversation_id} title changed: {conv_db.title}")
-                            session.add(conv_db)
-                        # 同步时间
-                        create_time = dateutil.parser.isoparse(conv["create_time"])
-                        if create_time != conv_db.create_time:
-                            conv_db.create_time = create_time
-                            logger.info(f"Conversation {conv_db.conversation_id} created time changed：{conv_db.create_time}")
-                            session.add(conv_db)
-                        conversations_map.pop(conv_db.conversation_id)
-                    elif not conv and conv_db.is_valid:  # 若数据库中存在，但 ChatGPT 中不存在，则将数据库中的对话标记为无效
-                        conv_db.is_valid = False
-                        logger.info(
-                            f"Conversation {conv_db.title}({conv_db.conversation_id}) not recorded, added to database")
-                        session.add(conv_db)
-
-                # 新增对话
-                for conv in conversations_map.values():
-                    new_conv = Conversation(
-                        conversation_id=conv["id"],
-                        title=conv["title"],
-                        is_valid=True,
-                        create_time=dateutil.parser.isoparse(conv["create_time"])
-                    )
-                    session.add(new_conv)
-                    logger.info(f"Found new conversation {conv['title']}({conv['id']})")
-
-                await session.commit()
-    except ChatGPTError as e:
-        logger.warning(f"Fetch conversation error: {e.source} {e.code}: {e.message}")
-    except Exception as e:
-        logger.error(e)
-        raise e
+    # 预热连接和同步对话在后台进行，不阻塞服务启动
+    app.state.warm_up_task = asyncio.create_task(warm_up_and_sync())
     logger.debug("Done!")
 
 
+async def warm_up_and_sync():
+    if config.get("run_reverse_proxy", False):
+        await asyncio.sleep(2)  # 等待 Proxy Server 启动
+    # 预先建立上游连接
+    await g.chatgpt_manager.warm_up()
+    logger.debug(f"Using {os.environ.get('CHATGPT_BASE_URL', '<default_bypass>')} as ChatGPT base url")
+    # 获取 ChatGPT 对话，并同步数据库
+    g.conversation_reconciler.start()
+
+
 # 关闭时
 @app.on_event("shutdown")
 async def on_shutdown():
+    # 先写完提问记录，其中可能提交标题生成任务
+    app.state.warm_up_task.cancel()
+    await g.conversation_reconciler.stop()
+    await g.ask_bookkeeper.stop()
+    await g.presence.stop()
+    await g.activity_tracker.stop()
+    await g.title_generator.stop()
+    await g.chatgpt_manager.close()
+    g.password_hasher.close()
     close_reverse_proxy()
 
 # @api.get("/routes")
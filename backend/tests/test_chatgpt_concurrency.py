@@ -0,0 +1,87 @@
+"""
+同一账号上的并发提问互不干扰，且每个账号同时进行的提问数不超过 max_concurrency
+上游由 httpx.MockTransport 模拟，回复中的模型和内容取自各自的请求
+"""
+import asyncio
+import json
+import random
+import uuid
+from types import SimpleNamespace
+
+import httpx
+
+from api.chatgpt import ChatGPTManager, ChatGPTAccount
+from api.enums import ChatModels
+
+
+class FakeUpstream:
+    def __init__(self):
+        self.running: dict[str, int] = {}
+        self.max_running: dict[str, int] = {}
+
+    def transport(self, account_name: str) -> httpx.MockTransport:
+        async def handler(request: httpx.Request) -> httpx.Response:
+            body = json.loads(request.content)
+            self.running[account_name] = self.running.get(account_name, 0) + 1
+            self.max_running[account_name] = max(self.max_running.get(account_name, 0),
+                                                 self.running[account_name])
+            try:
+                await asyncio.sleep(random.uniform(0.01, 0.05))
+            finally:
+                self.running[account_name] -= 1
+            conversation_id = body["conversation_id"] or str(uuid.uuid4())
+            message = {
+                "id": str(uuid.uuid4()),
+                "content": {"parts": [f"{account_name}: {body['messages'][0]['content']['parts'][0]}"]},
+                "metadata": {"model_slug": body["model"]},
+            }
+            lines = [f"data: {json.dumps({'message': message, 'conversation_id': conversation_id})}",
+                     "data: [DONE]"]
+            return httpx.Response(200, text="\n\n".join(lines))
+
+        return httpx.MockTransport(handler)
+
+
+def create_manager(upstream: FakeUpstream) -> ChatGPTManager:
+    manager = ChatGPTManager()
+    manager.accounts = [
+        ChatGPTAccount("free", "token-free", paid=False, max_concurrency=2),
+        ChatGPTAccount("paid", "token-paid", paid=True, max_concurrency=1),
+    ]
+    for account in manager.accounts:
+        account.chatbot.session = httpx.AsyncClient(transport=upstream.transport(account.name))
+    return manager
+
+
+async def ask(manager: ChatGPTManager, user_id: int, model_name: ChatModels) -> tuple[str, dict]:
+    user = SimpleNamespace(id=user_id, is_superuser=False, can_use_gpt4=True, can_use_paid=True)
+    message = f"question from {user_id}"
+    async with manager.queue_ask(user, model_name) as ticket:
+        await ticket.wait()
+        account = ticket.account
+        assert account.running <= account.max_concurrency
+        data = None
+        async for data in manager.ask(account, message, model_name=model_name):
+            pass
+    return account.name, data
+
+
+def test_concurrent_asks_with_mixed_models():
+    async def run():
+        upstream = FakeUpstream()
+        manager = create_manager(upstream)
+        models = [ChatModels.default, ChatModels.paid, ChatModels.gpt4] * 8
+        results = await asyncio.gather(*[ask(manager, user_id, model_name)
+                                         for user_id, model_name in enumerate(models)])
+        for user_id, (model_name, (account_name, data)) in enumerate(zip(models, results)):
+            assert data["model"] == model_name.value
+            assert data["message"] == f"{account_name}: question from {user_id}"
+            assert manager.conversation_accounts[data["conversation_id"]].name == account_name
+            if model_name != ChatModels.default:
+                assert account_name == "paid"
+        assert upstream.max_running["free"] <= 2
+        assert upstream.max_running["paid"] == 1
+        assert all(account.running == 0 for account in manager.accounts)
+        assert not manager.waiting_tickets
+
+    asyncio.run(run())
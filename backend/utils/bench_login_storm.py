@@ -0,0 +1,96 @@
+"""
+登录风暴下回复推送延迟的基准测试：模拟一路每 interval 毫秒推送一次的流式回复，同时发起大量并发登录，
+统计每次推送相对预定时间的延迟。分别测试密码哈希在线程池中计算（当前实现）和直接在事件循环中计算两种情况。
+使用临时数据库，不影响配置的数据库；在 backend 目录下运行：
+
+    python -m utils.bench_login_storm [--logins 30] [--rounds 3] [--interval 20]
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+from api.config import config
+
+# 须在导入数据库模块之前替换数据库
+database_path = os.path.join(tempfile.mkdtemp(), "bench_login_storm.db")
+config.set("database_url", f"sqlite+aiosqlite:///{database_path}")
+
+import httpx  # noqa: E402
+
+import api.globals as g  # noqa: E402
+from api.database import create_db_and_tables  # noqa: E402
+from utils.create_user import create_user  # noqa: E402
+
+USERNAME = "bench"
+PASSWORD = "bench-password"
+
+
+async def stream_replies(stop: asyncio.Event, interval: float, delays: list[float]):
+    """按固定间隔推送，记录每次实际推送时间相对预定时间的延迟"""
+    next_time = time.perf_counter() + interval
+    while not stop.is_set():
+        await asyncio.sleep(max(0.0, next_time - time.perf_counter()))
+        now = time.perf_counter()
+        delays.append(now - next_time)
+        next_time = max(next_time + interval, now)
+
+
+async def login_storm(client: httpx.AsyncClient, logins: int) -> list[int]:
+    responses = await asyncio.gather(*[
+        client.post("/auth/login", data={"username": USERNAME, "password": PASSWORD}) for _ in range(logins)])
+    return [response.status_code for response in responses]
+
+
+def percentile(values: list[float], p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+async def run(label: str, client: httpx.AsyncClient, args) -> None:
+    delays = []
+    elapsed = 0.0
+    codes = set()
+    for _ in range(args.rounds):
+        stop = asyncio.Event()
+        streamer = asyncio.create_task(stream_replies(stop, args.interval / 1000, delays))
+        start_time = time.perf_counter()
+        codes.update(await login_storm(client, args.logins))
+        elapsed += time.perf_counter() - start_time
+        stop.set()
+        await streamer
+    print(f"{label:>8}: {args.rounds}x{args.logins} logins in {elapsed:.2f}s, push delay "
+          f"p50 {percentile(delays, 0.5) * 1000:.1f}ms, p99 {percentile(delays, 0.99) * 1000:.1f}ms, "
+          f"max {max(delays) * 1000:.1f}ms, status {sorted(codes)}")
+
+
+async def main(args):
+    import main as server  # 导入 FastAPI 应用
+
+    await create_db_and_tables()
+    await create_user(USERNAME, USERNAME, "bench@bench.com", PASSWORD)
+    # 基准测试只使用正确的密码，但关闭限流以免影响结果
+    g.login_throttle.max_failures = 0
+    g.login_throttle.max_failures_per_ip = 0
+    g.password_hasher.max_pending = args.logins
+    try:
+        async with httpx.AsyncClient(app=server.app, base_url="http://bench") as client:
+            await run("pool", client, args)
+
+            async def run_inline(func, *func_args):
+                return func(*func_args)
+
+            g.password_hasher._run = run_inline
+            await run("inline", client, args)
+    finally:
+        g.password_hasher.close()
+        os.remove(database_path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure reply push delay under a login storm")
+    parser.add_argument("--logins", type=int, default=30, help="concurrent logins per round")
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--interval", type=float, default=20, help="milliseconds between pushes")
+    asyncio.run(main(parser.parse_args()))
@@ -1,4 +1,6 @@
 import asyncio, threading
+import base64
+import json
 
 
 def get_conversation_model(conversation) -> str:
@@ -15,6 +17,53 @@ def get_conversation_model(conversation) -> str:
         return result
 
 
+def get_active_branch(conversation) -> list[str]:
+    """从 current_node 回溯到根节点，返回从根到叶排列的消息 id"""
+    result = []
+    mapping = conversation["mapping"]
+    current_node = conversation.get("current_node")
+    while current_node and current_node in mapping:
+        result.append(current_node)
+        current_node = mapping[current_node].get("parent")
+    result.reverse()
+    return result
+
+
+def get_descendants(conversation, message_id: str) -> list[str]:
+    """返回 message_id 之后（其子树中，不含自身）的所有消息 id，按层级排列"""
+    result = []
+    mapping = conversation["mapping"]
+    queue = list(mapping[message_id].get("children") or [])
+    while queue:
+        node_id = queue.pop(0)
+        if node_id not in mapping:
+            continue
+        result.append(node_id)
+        queue.extend(mapping[node_id].get("children") or [])
+    return result
+
+
+def filter_conversation_mapping(conversation, message_ids: list[str]) -> dict:
+    """返回只包含指定消息的对话副本，不修改原对象（可能来自缓存）"""
+    result = {key: value for key, value in conversation.items() if key != "mapping"}
+    result["mapping"] = {message_id: conversation["mapping"][message_id] for message_id in message_ids}
+    return result
+
+
+def encode_cursor(values: list) -> str:
+    """将分页游标（排序字段的值）编码为不透明的字符串"""
+    return base64.urlsafe_b64encode(json.dumps(values, default=str).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> list | None:
+    """解码失败时返回 None"""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError):
+        return None
+    return values if isinstance(values, list) else None
+
+
 def async_wrap_iter(it):
     """Wrap blocking iterator into an asynchronous one"""
     loop = asyncio.get_event_loop()
@@ -0,0 +1,70 @@
+"""
+离线导出对话为 NDJSON，不经过 HTTP 服务；在 backend 目录下运行：
+
+    python -m utils.export_conversations -o conversations.ndjson [--source auto|mirror|upstream]
+        [--user-id ID] [--valid-only] [--concurrency N] [--resume]
+
+--resume 时从输出文件中最后一条完整记录的 cursor 继续，并截掉中断时写了一半的行
+"""
+import argparse
+import asyncio
+import json
+import os
+
+import api.globals as g
+from api.export import export_conversations
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+
+def find_resume_point(path: str) -> tuple[int | None, int]:
+    """返回最后一条完整记录的 cursor 及其结束位置"""
+    cursor, offset = None, 0
+    if not os.path.exists(path):
+        return cursor, offset
+    with open(path, "rb") as f:
+        position = 0
+        for line in f:
+            position += len(line)
+            if not line.endswith(b"\n"):
+                break
+            try:
+                cursor = json.loads(line)["cursor"]
+            except (ValueError, KeyError):
+                break
+            offset = position
+    return cursor, offset
+
+
+async def main(args):
+    cursor, offset = None, 0
+    if args.resume:
+        cursor, offset = find_resume_point(args.output)
+        logger.info(f"resume from cursor {cursor}")
+    count = 0
+    with open(args.output, "r+b" if args.resume and os.path.exists(args.output) else "wb") as f:
+        f.truncate(offset)
+        f.seek(offset)
+        try:
+            async for item in export_conversations(g.chatgpt_manager, args.source, user_id=args.user_id,
+                                                   is_valid=True if args.valid_only else None, cursor=cursor,
+                                                   concurrency=args.concurrency):
+                f.write((json.dumps(item, ensure_ascii=False) + "\n").encode())
+                count += 1
+                if item["error"] is not None:
+                    logger.warning(f"conversation {item['conversation']['conversation_id']}: {item['error']}")
+        finally:
+            await g.chatgpt_manager.close()
+    logger.info(f"exported {count} conversations to {args.output}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export conversations as NDJSON")
+    parser.add_argument("-o", "--output", required=True)
+    parser.add_argument("--source", choices=["auto", "mirror", "upstream"], default="auto")
+    parser.add_argument("--user-id", type=int, default=None)
+    parser.add_argument("--valid-only", action="store_true")
+    parser.add_argument("--concurrency", type=int, default=None)
+    parser.add_argument("--resume", action="store_true")
+    asyncio.run(main(parser.parse_args()))
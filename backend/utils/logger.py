@@ -3,7 +3,6 @@ import logging
 import logging.config
 import os
 from datetime import datetime
-import api.globals as g
 
 import yaml
 
@@ -11,6 +10,7 @@ from api.config import config
 
 
 def get_log_config():
+    import api.globals as g  # 避免循环导入：api.globals 中的模块也会使用 get_logger
     with open('logging_config.yaml', 'r') as f:
         log_config = yaml.safe_load(f.read())
     log_config['handlers']['file_handler']['filename'] = g.server_log_filename
@@ -19,6 +19,7 @@ def get_log_config():
 
 
 def setup_logger():
+    import api.globals as g
     log_dir = config.get("log_dir", "logs")
     os.makedirs(log_dir, exist_ok=True)
     g.server_log_filename = os.path.join(log_dir, f"{datetime.now().strftime('%Y%m%d_%H-%M-%S')}.log")
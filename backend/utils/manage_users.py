@@ -0,0 +1,87 @@
+"""
+批量管理用户，不经过 HTTP 服务；在 backend 目录下运行：
+
+    python -m utils.manage_users import users.csv      # 或 users.json（对象数组）
+    python -m utils.manage_users limit [--user-id ID ...] [--username-prefix PREFIX] [--include-superusers]
+        [--available-ask-count N] [--available-gpt4-ask-count N] [--max-conv-count N]
+        [--can-use-paid true|false] [--can-use-gpt4 true|false]
+
+CSV 的列与 JSON 的字段相同：username, nickname, email, password 或 hashed_password，以及可选的
+can_use_paid, can_use_gpt4, max_conv_count, available_ask_count, available_gpt4_ask_count, is_superuser；空值视为未填写
+"""
+import argparse
+import asyncio
+import csv
+import json
+
+from pydantic import parse_obj_as, ValidationError
+
+from api.database import create_db_and_tables
+from api.schema import UserImportSchema, BatchLimitSchema, LimitSchema
+from api.user_batch import import_users, update_limits
+import api.globals as g
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+
+def read_users(path: str) -> list[dict]:
+    if path.endswith(".json"):
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    with open(path, newline="", encoding="utf-8-sig") as f:
+        return [{key: value for key, value in row.items() if value != ""} for row in csv.DictReader(f)]
+
+
+async def run_import(args):
+    try:
+        users = parse_obj_as(list[UserImportSchema], read_users(args.file))
+    except ValidationError as e:
+        logger.error(f"invalid users in {args.file}: {e}")
+        return
+    created, skipped = await import_users(users)
+    if skipped:
+        logger.info(f"skipped {len(skipped)} existing users: {', '.join(skipped)}")
+    logger.info(f"created {created} users")
+
+
+async def run_limit(args):
+    limit = LimitSchema(**{key: getattr(args, key) for key in LimitSchema.__fields__
+                           if getattr(args, key) is not None})
+    count = await update_limits(BatchLimitSchema(user_ids=args.user_id, username_prefix=args.username_prefix,
+                                                 include_superusers=args.include_superusers, limit=limit))
+    logger.info(f"updated limits of {count} users")
+
+
+async def main(args):
+    await create_db_and_tables()
+    try:
+        await args.func(args)
+    finally:
+        g.password_hasher.close()
+
+
+def parse_bool(value: str) -> bool:
+    return value.lower() in ("1", "true", "yes")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Import users and update limits in batch")
+    subparsers = parser.add_subparsers(required=True)
+
+    import_parser = subparsers.add_parser("import", help="create users from a CSV or JSON file")
+    import_parser.add_argument("file")
+    import_parser.set_defaults(func=run_import)
+
+    limit_parser = subparsers.add_parser("limit", help="update limits of matching users")
+    limit_parser.add_argument("--user-id", type=int, action="append", default=None)
+    limit_parser.add_argument("--username-prefix", default=None)
+    limit_parser.add_argument("--include-superusers", action="store_true")
+    limit_parser.add_argument("--can-use-paid", type=parse_bool, default=None)
+    limit_parser.add_argument("--can-use-gpt4", type=parse_bool, default=None)
+    limit_parser.add_argument("--max-conv-count", type=int, default=None)
+    limit_parser.add_argument("--available-ask-count", type=int, default=None)
+    limit_parser.add_argument("--available-gpt4-ask-count", type=int, default=None)
+    limit_parser.set_defaults(func=run_limit)
+
+    asyncio.run(main(parser.parse_args()))